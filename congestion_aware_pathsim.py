@@ -7,7 +7,7 @@
 #     If avg stored latency is > l=500ms, don't use. Ping after use and store.
 
 import pathsim
-from random import choice
+import random as rand
 import stem
 import collections
 from models import *
@@ -20,14 +20,14 @@ min_ping = 500 # minimum ping to use circuit in milliseconds
 
 
 def ping_circuit(client_ip, guard_node, middle_node, exit_node,\
-    cons_rel_stats, descriptors, congmodel, pdelmodel):    
+    cons_rel_stats, descriptors, congmodel, pdelmodel, rng=rand):    
     ping_time = 0
     for node, coef in ((guard_node, 2), (middle_node, 2), (exit_node, 1)):
         rel_stat = cons_rel_stats[node]
-        is_exit = (stem.Flag.EXIT in rel_stat.flags)
-        is_guard = (stem.Flag.GUARD in rel_stat.flags)
+        is_exit = bool(rel_stat.flag_bits & pathsim.EXIT_BIT)
+        is_guard = bool(rel_stat.flag_bits & pathsim.GUARD_BIT)
         ping_time += coef*(congmodel.get_congestion(node,\
-            rel_stat.bandwidth, is_exit, is_guard))
+            rel_stat.bandwidth, is_exit, is_guard, rng))
 
     # ca-tor subtracts minrtt from its pings to isolate congestion
     # so we dont actually want to include prop delay
@@ -48,18 +48,19 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
     guards, circ_time, circ_fast, circ_stable, circ_internal, circ_ip,
     circ_port, congmodel, pdelmodel, weighted_exits=None,
     exits_exact=False, weighted_middles=None, weighted_guards=None,
-    callbacks=None):
+    callbacks=None, rng=rand):
     """Creates path for requested circuit based on the input consensus
     statuses and descriptors. Uses congestion-aware path selection.
     Inputs:
-        cons_rel_stats: (dict) relay fingerprint keys and relay status vals
+        cons_rel_stats: (dict) relay ID keys and relay status vals
         cons_valid_after: (int) timestamp of valid_after for consensus
         cons_fresh_until: (int) timestamp of fresh_until for consensus
         cons_bw_weights: (dict) bw_weights of consensus
         cons_bwweightscale: (should be float()able) bwweightscale of consensus
-        descriptors: (dict) relay fingerprint keys and descriptor vals
-        hibernating_status: (dict) indicates hibernating relays
-        guards: (dict) contains guards of requesting client
+        descriptors: (dict) relay ID keys and descriptor vals
+        hibernating_status: (HibernatingStatus) indicates hibernating relays,
+            which are disabled in weighted_exits and weighted_middles
+        guards: (GuardList) contains guards of requesting client
         circ_time: (int) timestamp of circuit request
         circ_fast: (bool) all relays should be fast
         circ_stable: (bool) all relays should be stable
@@ -68,14 +69,15 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
         circ_port: (int) desired TCP port (None if not known)
         congmodel: congestion model
         pdelmodel: propagation delay model
-        weighted_exits: (list) (middle, cum_weight) pairs for exit position
+        weighted_exits: (ConditionalSampler) for exit position
         exits_exact: (bool) Is weighted_exits exact or does it need rechecking?
             weighed_exits is special because exits are chosen first and thus
             don't depend on the other circuit positions, and so potentially are        
             precomputed exactly.
-        weighted_middles: (list) (middle, cum_weight) pairs for middle position
-        weighted_guards: (list) (middle, cum_weight) pairs for middle position
+        weighted_middles: (ConditionalSampler) for middle position
+        weighted_guards: (ConditionalSampler) for guard position
         callbacks: object w/ method circuit_creation(circuit)        
+        rng: random number generator of requesting client
     Output:
         circuit: (dict) a newly created circuit with keys
             'time': (int) seconds from time zero
@@ -83,7 +85,7 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
             'stable': (bool) relays must have Stable flag
             'internal': (bool) is internal (e.g. for hidden service)
             'dirty_time': (int) timestamp of time dirtied, None if clean
-            'path': (tuple) list in-order fingerprints for path's nodes
+            'path': (tuple) list in-order relay IDs for path's nodes
             'covering': (set) ports with needs covered by circuit
             'avg_ping': (float) average ping time during most-recent use
     """
@@ -97,20 +99,11 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
     ntor_supported = False
     while (num_attempts < pathsim.TorOptions.max_populate_attempts) and\
         (not ntor_supported):            
-        # select exit node
-        i = 1
-        while (True):
-            exit_node = pathsim.select_exit_node(cons_bw_weights,
-                cons_bwweightscale, cons_rel_stats, descriptors, circ_fast,
-                circ_stable, circ_internal, circ_ip, circ_port, weighted_exits,
-                exits_exact)
-    #        exit_node = pathsim.select_weighted_node(weighted_exits)
-            if (not hibernating_status[exit_node]):
-                break
-            if pathsim._testing:
-                print('Exit selection #{0} is hibernating - retrying.'.\
-                    format(i))
-            i += 1
+        # select exit node, which is never hibernating
+        exit_node = pathsim.select_exit_node(cons_bw_weights,
+            cons_bwweightscale, cons_rel_stats, descriptors, circ_fast,
+            circ_stable, circ_internal, circ_ip, circ_port, weighted_exits,
+            exits_exact, hibernating_status, rng)
         if pathsim._testing:    
             print('Exit node: {0} [{1}]'.format(
                 cons_rel_stats[exit_node].nickname,
@@ -126,8 +119,8 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
             circ_guards = pathsim.get_guards_for_circ(cons_bw_weights,\
                 cons_bwweightscale, cons_rel_stats, descriptors,\
                 circ_fast, circ_stable, guards,\
-                exit_node, circ_time, weighted_guards)   
-            guard_node = choice(circ_guards)
+                exit_node, circ_time, weighted_guards, rng)   
+            guard_node = rng.choice(circ_guards)
             if (hibernating_status[guard_node]):
                 if (not guards[guard_node]['made_contact']):
                     if pathsim._testing:
@@ -158,20 +151,13 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
                 cons_rel_stats[guard_node].fingerprint))
     
         # select middle node
-        # As with exit selection, hibernating status checked here to mirror Tor
+        # As with exit selection, hibernating relays are excluded to mirror Tor
         # selecting middle, having the circuit fail, reselecting a path,
-        # and attempting circuit creation again.    
-        i = 1
-        while (True):
-            middle_node = pathsim.select_middle_node(cons_bw_weights,\
-                cons_bwweightscale, cons_rel_stats, descriptors, circ_fast,\
-                circ_stable, exit_node, guard_node, weighted_middles)
-            if (not hibernating_status[middle_node]):
-                break
-            if pathsim._testing:
-                print(\
-                'Middle selection #{0} is hibernating - retrying.'.format(i))
-            i += 1    
+        # and attempting circuit creation again.
+        middle_node = pathsim.select_middle_node(cons_bw_weights,\
+            cons_bwweightscale, cons_rel_stats, descriptors, circ_fast,\
+            circ_stable, exit_node, guard_node, weighted_middles,\
+            hibernating_status, rng)
         if pathsim._testing:
             print('Middle node: {0} [{1}]'.format(
                 cons_rel_stats[middle_node].nickname,
@@ -194,7 +180,7 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
     if pathsim._testing: print 'Doing {0} circuit pings on creation... '.format(num_pings_create),
     for i in xrange(num_pings_create):
         cum_ping_time += ping_circuit(client_ip, guard_node, middle_node,\
-            exit_node, cons_rel_stats, descriptors, congmodel, pdelmodel)
+            exit_node, cons_rel_stats, descriptors, congmodel, pdelmodel, rng)
     avg_ping_time = float(cum_ping_time)/num_pings_create
     if pathsim._testing: print "ave congestion is {0}".format(avg_ping_time)
 
@@ -296,7 +282,8 @@ at {0}'.format(stream['time']))
                 stable, False, stream['ip'], stream['port'],
                 congmodel, pdelmodel,
                 stream_weighted_exits, False,
-                weighted_middles, weighted_guards, callbacks)
+                weighted_middles, weighted_guards, callbacks,
+                client_state['rng'])
         elif (stream['type'] == 'resolve'):
             new_circ = create_circuit(cons_rel_stats,
                 cons_valid_after, cons_fresh_until,
@@ -305,7 +292,8 @@ at {0}'.format(stream['time']))
                 False, False, None, None,
                 congmodel, pdelmodel,
                 stream_weighted_exits, True,
-                weighted_middles, weighted_guards, callbacks)
+                weighted_middles, weighted_guards, callbacks,
+                client_state['rng'])
         else:
             raise ValueError('Unrecognized stream in client_assign_stream(): \
 {0}'.format(stream['type']))        
@@ -331,7 +319,8 @@ stream.'.format(stream['time']))
     exit_node = stream_assigned['path'][2]
     for i in xrange(num_pings_use):
         cum_ping_time += ping_circuit(client_ip, guard_node, middle_node,\
-            exit_node, cons_rel_stats, descriptors, congmodel, pdelmodel)
+            exit_node, cons_rel_stats, descriptors, congmodel, pdelmodel,\
+            client_state['rng'])
     stream_assigned['avg_ping'] = float(cum_ping_time)/num_pings_use
     if pathsim._testing: print "ave congestion is {0}".format(stream_assigned['avg_ping'])
     
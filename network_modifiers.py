@@ -4,6 +4,7 @@ from stem import Flag
 from stem.exit_policy import ExitPolicy
 import json
 import pathsim
+import nsf_format
 from datetime import datetime
 
 class Enum(tuple): __getattr__ = tuple.index
@@ -21,10 +22,11 @@ def compute_tot_bandwidths(cons_rel_stats):
     # (cf. dirvote.c:networkstatus_compute_consensus())
     G = M = E = D = T = 0
     for fprint, rel_stat in cons_rel_stats.iteritems():
-        if (Flag.RUNNING not in rel_stat.flags):
+        flag_bits = rel_stat.flag_bits
+        if (not (flag_bits & pathsim.RUNNING_BIT)):
             continue
-        is_guard = Flag.GUARD in rel_stat.flags
-        is_exit = (Flag.EXIT in rel_stat.flags) and (Flag.BADEXIT not in rel_stat.flags)
+        is_guard = (flag_bits & pathsim.GUARD_BIT)
+        is_exit = (flag_bits & pathsim.EXIT_BIT) and (not (flag_bits & pathsim.BADEXIT_BIT))
 
         T += rel_stat.bandwidth            
         if (is_guard and not is_exit):
@@ -231,7 +233,8 @@ class AdversaryInsertion(object):
             hibernating = False
             family = {}
             address = '10.'+num_str+'.0.0' # avoid /16 conflicts
-            exit_policy = ExitPolicy('reject *:*')
+            exit_policy = nsf_format.compile_exit_policy(
+                ExitPolicy('reject *:*'))
             ntor_onion_key = num_str # indicate ntor support w/ val != None
             self.adv_descriptors[fingerprint] = pathsim.ServerDescriptor(fingerprint,
                 hibernating, nickname, family, address, exit_policy,
@@ -254,7 +257,8 @@ class AdversaryInsertion(object):
             hibernating = False
             family = {}
             address = '10.'+str(num_adv_guards+i+1)+'.0.0' # avoid /16 conflicts
-            exit_policy = ExitPolicy('accept *:*')
+            exit_policy = nsf_format.compile_exit_policy(
+                ExitPolicy('accept *:*'))
             ntor_onion_key = num_str # indicate ntor support w/ val != None
             self.adv_descriptors[fingerprint] = pathsim.ServerDescriptor(fingerprint,
                 hibernating, nickname, family, address, exit_policy,
@@ -271,7 +275,6 @@ class AdversaryInsertion(object):
         self.add_adv_guards(num_adv_guards, adv_guard_cons_bw)
         self.add_adv_exits(num_adv_guards, num_adv_exits, adv_exit_cons_bw)
         self.testing = testing
-        self.first_modification = True
         self.bww_errors = Enum(("NO_ERROR","SUMG_ERROR", "SUME_ERROR",
                 "SUMD_ERROR","BALANCE_MID_ERROR", "BALANCE_EG_ERROR",
                 "RANGE_ERROR"))
@@ -281,10 +284,8 @@ class AdversaryInsertion(object):
         descriptors dicts."""
 
         # add adversarial descriptors to nsf descriptors
-        # only add once because descriptors variable is assumed persistent
-        if (self.first_modification == True):
-            network_state.descriptors.update(self.adv_descriptors)
-            self.first_modification = False
+        # add every period so that they count as seen in the descriptor store
+        network_state.descriptors.update(self.adv_descriptors)
 
         # if insertion time has been reached, add adversarial relays into
         # consensus and hibernating status list
@@ -334,7 +335,6 @@ class ExcludedRelaysInsertion(object):
         self.bww_errors = Enum(("NO_ERROR","SUMG_ERROR", "SUME_ERROR",
                 "SUMD_ERROR","BALANCE_MID_ERROR", "BALANCE_EG_ERROR",
                 "RANGE_ERROR"))
-        self.first_modification = True
         #timestamp in UTC or local time? It should be UTC; but the code overall
         #in TorPS uses local time.
         hibernating = False
@@ -344,7 +344,7 @@ class ExcludedRelaysInsertion(object):
 
             self.excluded_relays_descriptors[fp] = \
                 pathsim.ServerDescriptor(fp,
-                        hibernating, relay_data['nickname'], relay_data['family'], relay_data['address'], ExitPolicy(*relay_data['exit_policy']), 1
+                        hibernating, relay_data['nickname'], relay_data['family'], relay_data['address'], nsf_format.compile_exit_policy(ExitPolicy(*relay_data['exit_policy'])), 1
                 )
         relays = relays.values()
         relays.sort(key = lambda x: x['last_seen_in'])
@@ -354,9 +354,7 @@ class ExcludedRelaysInsertion(object):
     def modify_network_state(self, network_state):
 
         if self.apply_after <= network_state.cons_valid_after:
-            if self.first_modification:
-                network_state.descriptors.update(self.excluded_relays_descriptors)
-                self.first_modification = False
+            network_state.descriptors.update(self.excluded_relays_descriptors)
             added_relay = 0;
             for fp, relay_data in self.excluded_relays.iteritems():
                 if fp not in network_state.cons_rel_stats:
@@ -399,11 +397,17 @@ class RaiseGuardConsBWThreshold(object):
         num_guard_flags = 0
         num_guard_flags_removed = 0
         for fprint, rel_stat in network_state.cons_rel_stats.iteritems():
-            if (Flag.GUARD in rel_stat.flags):
+            if (rel_stat.flag_bits & pathsim.GUARD_BIT):
                 num_guard_flags += 1
                 if (rel_stat.bandwidth < self.guard_bw_threshold):
                     num_guard_flags_removed += 1
-                    rel_stat.flags = filter(lambda x: x != Flag.GUARD, rel_stat.flags)
+                    # replace rather than modify entry, which may be shared
+                    # with the network states of later delta NSFs
+                    network_state.cons_rel_stats[fprint] = \
+                        pathsim.RouterStatusEntry(fprint, rel_stat.nickname,
+                            filter(lambda x: x != Flag.GUARD, rel_stat.flags),
+                            rel_stat.bandwidth,
+                            rel_stat.flag_bits & ~pathsim.GUARD_BIT)
         if self.testing:
             print('Removed {} guard flags out of {}'.format(num_guard_flags_removed,
                 num_guard_flags))
@@ -0,0 +1,950 @@
+### Columnar network state file (NSF) format ###
+# A columnar NSF stores one consensus period as fixed-width arrays rather than
+# as pickled objects, so that it can be memory-mapped and read in place.
+# This replaces file reads and unpickling, but decoding still builds the
+# per-relay RouterStatusEntry and ServerDescriptor objects that the simulator
+# uses, from Python lists of the columns, each period.
+#
+# Layout (all integers little-endian):
+#   header: magic (8 bytes), format version (uint32), meta length (uint32)
+#   meta: pickled dict with the consensus times and bandwidth weights, the
+#       flag names in bit order, and (typecode, offset, length) per column
+#   columns: fixed-width arrays, each starting on an 8-byte boundary, with
+#       offsets relative to the end of the (padded) meta section
+#
+# Relay columns (one row per consensus entry, sorted by fingerprint):
+#   fingerprint (20 raw bytes), nickname (string index), flags (bitmask),
+#   bandwidth, descriptor (row in descriptor columns or NO_ENTRY)
+# Descriptor columns (one row per descriptor, sorted by fingerprint):
+#   desc_fingerprint, desc_nickname, address (packed IPv4), hibernating,
+#   family, exit_policy (row in policy columns), ntor_onion_key
+# Exit policy columns (one row per distinct policy):
+#   policy_first_rule, policy_num_rules (rows in rule columns),
+#   policy_exiting_allowed
+# Exit policy rule columns:
+#   policy_rules (fixed-width rows of accept/reject, address type, masked bits,
+#   port interval, address and mask), policy_rule_text (string index)
+# Hibernating-status columns (in file order):
+#   hib_time, hib_fingerprint, hib_value
+# String table: string_offsets, strings
+#
+# Exit policies are stored compiled into rule tables at process time and are
+# evaluated directly by CompiledExitPolicy, without re-parsing with stem.
+# Version 1 files, which stored exit policies as strings, remain readable, as
+# do version 2 files, which stored hibernating statuses by descriptor row.
+#
+# Delta NSFs (meta kind 'delta') store only the consensus entries and
+# descriptors that were added or changed since the NSF whose valid_after is
+# meta base_valid_after, plus the fingerprints of those removed since then:
+#   removed_fingerprint, removed_desc_fingerprint (20 raw bytes each)
+# Bandwidth weights and hibernating statuses are always stored in full. A
+# chain of deltas follows each keyframe (a complete NSF) and is read with
+# NetworkStateReader.
+#
+# Pickle-format NSFs (three pickled objects per file) remain readable through
+# read_network_state_file() and read_network_state_times().
+
+import binascii
+import bisect
+import collections
+import cPickle as pickle
+import datetime
+import hashlib
+import mmap
+import os
+import socket
+import struct
+import sys
+from array import array
+
+from stem.exit_policy import ExitPolicy
+
+import pathsim
+
+NSF_MAGIC = 'TORPSNSF'
+NSF_VERSION = 3
+NO_ENTRY = 0xFFFFFFFF
+NSF_NAME_FORMAT = '%Y-%m-%d-%H-%M-%S-network_state'
+
+_HEADER = struct.Struct('<8sII')
+_ALIGN = 8
+_FINGERPRINT_LEN = 20
+# is_accept, address type, masked bits, port interval, address, mask
+_RULE = struct.Struct('<BBBxHHII')
+_RULE_WILDCARD = 0
+_RULE_IPV4 = 1
+_RULE_IPV6 = 2
+_RULE_ADDRESS_TYPES = {'Wildcard': _RULE_WILDCARD, 'IPv4': _RULE_IPV4,
+                       'IPv6': _RULE_IPV6}
+_NO_MASKED_BITS = 255
+# compiled policies shared across files, keyed by their rule-table bytes,
+# with the least recently used dropped beyond _COMPILED_POLICY_CACHE_MAX
+_compiled_policy_cache = collections.OrderedDict()
+_COMPILED_POLICY_CACHE_MAX = 100000
+# compiled policies keyed by their string form, as pickle-format NSFs and
+# version 1 columnar NSFs store them, with the same limit
+_policy_string_cache = collections.OrderedDict()
+
+
+def _align(n):
+    return (n + _ALIGN - 1) & ~(_ALIGN - 1)
+
+
+def _to_bytes(values, typecode):
+    a = array(typecode, values)
+    if (sys.byteorder != 'little'):
+        a.byteswap()
+    return a.tostring()
+
+
+def pack_fingerprint(fingerprint):
+    """Returns 20-byte binary form of hex fingerprint."""
+    packed = binascii.unhexlify(fingerprint)
+    if (len(packed) != _FINGERPRINT_LEN) or \
+            (binascii.hexlify(packed).upper() != fingerprint):
+        raise ValueError('Fingerprint not 40 uppercase hex digits: {0}'. \
+                         format(fingerprint))
+    return packed
+
+
+def pack_address(address):
+    """Returns IPv4 address string as an integer."""
+    packed = struct.unpack('!I', socket.inet_aton(address))[0]
+    if (unpack_address(packed) != address):
+        raise ValueError('Address not in dotted-quad form: {0}'. \
+                         format(address))
+    return packed
+
+
+def unpack_address(packed):
+    """Returns integer IPv4 address as a dotted-quad string."""
+    return socket.inet_ntoa(struct.pack('!I', packed))
+
+
+class CompiledExitPolicyRule(object):
+    """Exit policy rule evaluated from its compiled table row. Provides the
+    parts of the stem.exit_policy.ExitPolicyRule interface used by TorPS."""
+    __slots__ = ('is_accept', 'address_type', 'masked_bits', 'min_port',
+                 'max_port', 'address', 'mask', 'text')
+
+    def __init__(self, is_accept, address_type, masked_bits, min_port,
+                 max_port, address, mask, text):
+        self.is_accept = is_accept
+        self.address_type = address_type
+        self.masked_bits = masked_bits
+        self.min_port = min_port
+        self.max_port = max_port
+        self.address = address
+        self.mask = mask
+        self.text = text
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+    def __str__(self):
+        return self.text
+
+    def is_address_wildcard(self):
+        return (self.address_type == _RULE_WILDCARD)
+
+    def is_port_wildcard(self):
+        return (self.min_port in (0, 1)) and (self.max_port == 65535)
+
+    def get_masked_bits(self):
+        return self.masked_bits
+
+    def pack(self):
+        return _RULE.pack(int(self.is_accept), self.address_type,
+                          _NO_MASKED_BITS if (self.masked_bits is None) else \
+                              self.masked_bits,
+                          self.min_port, self.max_port, self.address, self.mask)
+
+
+class CompiledExitPolicy(object):
+    """Exit policy as a table of compiled rules. Provides the parts of the
+    stem.exit_policy.ExitPolicy interface used by TorPS (rule iteration and
+    can_exit_to()) for IPv4 destinations."""
+    __slots__ = ('rules', 'exiting_allowed')
+
+    def __init__(self, rules, exiting_allowed):
+        self.rules = rules
+        self.exiting_allowed = exiting_allowed
+
+    def __getstate__(self):
+        return (self.rules, self.exiting_allowed)
+
+    def __setstate__(self, state):
+        self.rules, self.exiting_allowed = state
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __str__(self):
+        return ', '.join(rule.text for rule in self.rules)
+
+    def is_exiting_allowed(self):
+        return self.exiting_allowed
+
+    def can_exit_to(self, address, port):
+        """Replicates stem's ExitPolicy.can_exit_to() for an IPv4 address and
+        port, using the precomputed rule table."""
+        if (not self.exiting_allowed):
+            return False
+        try:
+            address = struct.unpack('!I', socket.inet_aton(address))[0]
+        except socket.error:
+            raise ValueError('Compiled exit policies only support IPv4 \
+destinations: {0}'.format(address))
+        for rule in self.rules:
+            if (rule.address_type == _RULE_IPV6):
+                continue
+            if (rule.address_type == _RULE_IPV4) and \
+                    ((address & rule.mask) != rule.address):
+                continue
+            if (port < rule.min_port) or (port > rule.max_port):
+                continue
+            return rule.is_accept
+        return True
+
+
+def compile_exit_policy(exit_policy):
+    """Returns CompiledExitPolicy equivalent to stem ExitPolicy."""
+    if isinstance(exit_policy, CompiledExitPolicy):
+        return exit_policy
+    rules = []
+    for rule in exit_policy:
+        address_type = _RULE_ADDRESS_TYPES[rule.get_address_type()]
+        address = mask = 0
+        if (address_type == _RULE_IPV4):
+            mask = pack_address(rule.get_mask())
+            address = struct.unpack('!I',
+                                    socket.inet_aton(rule.address))[0] & mask
+        rules.append(CompiledExitPolicyRule(rule.is_accept, address_type,
+                                            rule.get_masked_bits(), rule.min_port, rule.max_port,
+                                            address, mask, str(rule)))
+    return CompiledExitPolicy(tuple(rules), exit_policy.is_exiting_allowed())
+
+
+def compile_exit_policy_string(policy_string):
+    """Returns CompiledExitPolicy of exit policy string (rules separated by
+    ', '). Policies already compiled from the same string are reused, so
+    relays with the same policy share one object."""
+    policy = _policy_string_cache.pop(policy_string, None)
+    if (policy is None):
+        policy = compile_exit_policy(ExitPolicy(*policy_string.split(', ')))
+        if (len(_policy_string_cache) >= _COMPILED_POLICY_CACHE_MAX):
+            _policy_string_cache.popitem(last=False)
+    # (re)insert as most recently used
+    _policy_string_cache[policy_string] = policy
+    return policy
+
+
+class _StringTable(object):
+    """Deduplicated table of strings referenced by index from columns."""
+
+    def __init__(self):
+        self.index = {}
+        self.strings = []
+
+    def add(self, s):
+        if (s is None):
+            return NO_ENTRY
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        if (s not in self.index):
+            self.index[s] = len(self.strings)
+            self.strings.append(s)
+        return self.index[s]
+
+
+def _relay_key(rel_stat):
+    """Returns the part of a consensus entry stored in an NSF."""
+    return (rel_stat.nickname, frozenset(rel_stat.flags), rel_stat.bandwidth)
+
+
+def _descriptor_key(desc):
+    """Returns the part of a descriptor stored in an NSF."""
+    policy = compile_exit_policy(desc.exit_policy)
+    return (bool(desc.hibernating), desc.nickname, frozenset(desc.family),
+            desc.address, ''.join(rule.pack() for rule in policy.rules),
+            policy.exiting_allowed, desc.ntor_onion_key)
+
+
+def encode_network_state(consensus, descriptors, hibernating_statuses,
+                         base=None):
+    """Returns columnar NSF contents as a string.
+    Inputs:
+        consensus: (NetworkStatusDocument) slim consensus
+        descriptors: (dict) fingerprint keys and ServerDescriptor vals
+        hibernating_statuses: (list) (time, fingerprint, hibernating) triples
+        base: (tuple) (consensus, descriptors) of the preceding NSF, if a
+            delta against it should be written instead of a keyframe
+    """
+    relays = consensus.relays
+    removed_relays = []
+    removed_descriptors = []
+    if (base is not None):
+        base_consensus, base_descriptors = base
+        base_relays = base_consensus.relays
+        removed_relays = sorted(fprint for fprint in base_relays
+                                if (fprint not in relays))
+        relays = dict((fprint, rel_stat) for fprint, rel_stat in
+                      relays.iteritems() if (fprint not in base_relays) or \
+                          (_relay_key(rel_stat) != \
+                               _relay_key(base_relays[fprint])))
+        removed_descriptors = sorted(fprint for fprint in base_descriptors
+                                     if (fprint not in descriptors))
+        descriptors = dict((fprint, desc) for fprint, desc in
+                           descriptors.iteritems() if \
+                               (fprint not in base_descriptors) or \
+                               (_descriptor_key(desc) != \
+                                    _descriptor_key(base_descriptors[fprint])))
+    relay_fprints = sorted(relays)
+    desc_fprints = sorted(descriptors)
+    desc_rows = dict((fprint, i) for i, fprint in enumerate(desc_fprints))
+    strings = _StringTable()
+
+    flag_names = sorted(set(flag for fprint in relay_fprints
+                            for flag in relays[fprint].flags))
+    if (len(flag_names) > 32):
+        raise ValueError('Too many distinct flags for bitmask: {0}'. \
+                         format(len(flag_names)))
+    flag_bits = dict((flag, 1 << i) for i, flag in enumerate(flag_names))
+
+    columns = []
+    # relay columns
+    columns.append(('fingerprint', 'B', ''.join(
+        pack_fingerprint(fprint) for fprint in relay_fprints)))
+    columns.append(('nickname', 'I', _to_bytes(
+        [strings.add(relays[fprint].nickname) for fprint in relay_fprints],
+        'I')))
+    columns.append(('flags', 'I', _to_bytes(
+        [sum(flag_bits[flag] for flag in set(relays[fprint].flags))
+         for fprint in relay_fprints], 'I')))
+    columns.append(('bandwidth', 'I', _to_bytes(
+        [NO_ENTRY if (relays[fprint].bandwidth is None) else \
+             relays[fprint].bandwidth for fprint in relay_fprints], 'I')))
+    columns.append(('descriptor', 'I', _to_bytes(
+        [desc_rows.get(fprint, NO_ENTRY) for fprint in relay_fprints], 'I')))
+
+    # descriptor columns
+    descs = [descriptors[fprint] for fprint in desc_fprints]
+    columns.append(('desc_fingerprint', 'B', ''.join(
+        pack_fingerprint(desc.fingerprint) for desc in descs)))
+    columns.append(('desc_nickname', 'I', _to_bytes(
+        [strings.add(desc.nickname) for desc in descs], 'I')))
+    columns.append(('address', 'I', _to_bytes(
+        [pack_address(desc.address) for desc in descs], 'I')))
+    columns.append(('hibernating', 'B', _to_bytes(
+        [int(bool(desc.hibernating)) for desc in descs], 'B')))
+    columns.append(('family', 'I', _to_bytes(
+        [strings.add(' '.join(sorted(desc.family))) for desc in descs], 'I')))
+    policy_rows = {}
+    policy_first_rule = []
+    policy_num_rules = []
+    policy_exiting_allowed = []
+    rule_rows = []
+    rule_texts = []
+    desc_policies = []
+    for desc in descs:
+        policy = compile_exit_policy(desc.exit_policy)
+        key = (''.join(rule.pack() for rule in policy.rules),
+               policy.exiting_allowed)
+        if (key not in policy_rows):
+            policy_rows[key] = len(policy_first_rule)
+            policy_first_rule.append(len(rule_texts))
+            policy_num_rules.append(len(policy.rules))
+            policy_exiting_allowed.append(int(policy.exiting_allowed))
+            rule_rows.append(key[0])
+            rule_texts.extend(strings.add(rule.text) for rule in policy.rules)
+        desc_policies.append(policy_rows[key])
+    columns.append(('exit_policy', 'I', _to_bytes(desc_policies, 'I')))
+    columns.append(('ntor_onion_key', 'I', _to_bytes(
+        [strings.add(desc.ntor_onion_key) for desc in descs], 'I')))
+
+    # exit policy columns
+    columns.append(('policy_first_rule', 'I', _to_bytes(policy_first_rule,
+                                                         'I')))
+    columns.append(('policy_num_rules', 'I', _to_bytes(policy_num_rules, 'I')))
+    columns.append(('policy_exiting_allowed', 'B', _to_bytes(
+        policy_exiting_allowed, 'B')))
+    columns.append(('policy_rules', 'B', ''.join(rule_rows)))
+    columns.append(('policy_rule_text', 'I', _to_bytes(rule_texts, 'I')))
+
+    # hibernating-status columns
+    columns.append(('hib_time', 'I', _to_bytes(
+        [hs[0] for hs in hibernating_statuses], 'I')))
+    columns.append(('hib_fingerprint', 'B', ''.join(
+        pack_fingerprint(hs[1]) for hs in hibernating_statuses)))
+    columns.append(('hib_value', 'B', _to_bytes(
+        [int(bool(hs[2])) for hs in hibernating_statuses], 'B')))
+
+    # removed-entry columns (deltas only)
+    if (base is not None):
+        columns.append(('removed_fingerprint', 'B', ''.join(
+            pack_fingerprint(fprint) for fprint in removed_relays)))
+        columns.append(('removed_desc_fingerprint', 'B', ''.join(
+            pack_fingerprint(fprint) for fprint in removed_descriptors)))
+
+    # string table
+    string_offsets = [0]
+    for s in strings.strings:
+        string_offsets.append(string_offsets[-1] + len(s))
+    columns.append(('string_offsets', 'I', _to_bytes(string_offsets, 'I')))
+    columns.append(('strings', 'B', ''.join(strings.strings)))
+
+    # lay out columns
+    column_meta = {}
+    chunks = []
+    offset = 0
+    for name, typecode, data in columns:
+        itemsize = array(typecode).itemsize
+        column_meta[name] = (typecode, offset, len(data) // itemsize)
+        padded_len = _align(len(data))
+        chunks.append(data + '\0' * (padded_len - len(data)))
+        offset += padded_len
+
+    meta = {'valid_after': pathsim.timestamp(consensus.valid_after),
+            'fresh_until': pathsim.timestamp(consensus.fresh_until),
+            'bandwidth_weights': consensus.bandwidth_weights,
+            'bwweightscale': consensus.bwweightscale,
+            'flag_names': flag_names,
+            'num_relays': len(relay_fprints),
+            'num_descriptors': len(desc_fprints),
+            'num_hibernating_statuses': len(hibernating_statuses),
+            'columns': column_meta}
+    if (base is not None):
+        meta['kind'] = 'delta'
+        meta['base_valid_after'] = pathsim.timestamp(base[0].valid_after)
+        meta['num_removed_relays'] = len(removed_relays)
+        meta['num_removed_descriptors'] = len(removed_descriptors)
+    meta_data = pickle.dumps(meta, pickle.HIGHEST_PROTOCOL)
+    header = _HEADER.pack(NSF_MAGIC, NSF_VERSION, len(meta_data))
+    meta_len = len(header) + len(meta_data)
+    return header + meta_data + '\0' * (_align(meta_len) - meta_len) + \
+           ''.join(chunks)
+
+
+def write_network_state_file(path, consensus, descriptors,
+                             hibernating_statuses, base=None):
+    """Writes network state to path in columnar format, as a delta against
+    base (see encode_network_state()) if given."""
+    with open(path, 'wb') as f:
+        f.write(encode_network_state(consensus, descriptors,
+                                     hibernating_statuses, base))
+
+
+class Column(object):
+    """Read-only view of a fixed-width array inside a mapped NSF.
+    Items are unpacked from the mapping on access, without copying."""
+
+    def __init__(self, buf, typecode, offset, length):
+        self.buf = buf
+        self.typecode = typecode
+        self.offset = offset
+        self.length = length
+        self.itemsize = array(typecode).itemsize
+        self.struct = struct.Struct('<' + typecode)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if (i < 0):
+            i += self.length
+        if (i < 0) or (i >= self.length):
+            raise IndexError('column index out of range')
+        return self.struct.unpack_from(self.buf,
+                                       self.offset + i * self.itemsize)[0]
+
+    def tostring(self):
+        return self.buf[self.offset:self.offset + self.length * self.itemsize]
+
+    def tolist(self):
+        a = array(self.typecode)
+        a.fromstring(self.tostring())
+        if (sys.byteorder != 'little'):
+            a.byteswap()
+        return a.tolist()
+
+
+class NetworkStateFile(object):
+    """Columnar NSF read in place from a buffer (typically an mmap). Columns
+    are decoded from the buffer into network state objects on request."""
+
+    def __init__(self, buf, offset=0):
+        magic, version, meta_len = _HEADER.unpack_from(buf, offset)
+        if (magic != NSF_MAGIC):
+            raise ValueError('Not a columnar network state file.')
+        if (version < 1) or (version > NSF_VERSION):
+            raise ValueError('Unsupported network state file version: {0}'. \
+                             format(version))
+        meta_start = offset + _HEADER.size
+        self.meta = pickle.loads(buf[meta_start:meta_start + meta_len])
+        self.buf = buf
+        self.base = offset + _align(_HEADER.size + meta_len)
+        self.version = version
+        self.valid_after = self.meta['valid_after']
+        self.fresh_until = self.meta['fresh_until']
+        self.is_delta = (self.meta.get('kind') == 'delta')
+        self._strings = None
+
+    def column(self, name):
+        typecode, offset, length = self.meta['columns'][name]
+        return Column(self.buf, typecode, self.base + offset, length)
+
+    def fingerprints(self, name):
+        """Returns hex fingerprints stored in fingerprint column name."""
+        data = self.column(name).tostring()
+        return [intern(binascii.hexlify(data[i:i + _FINGERPRINT_LEN]).upper())
+                for i in xrange(0, len(data), _FINGERPRINT_LEN)]
+
+    def strings(self):
+        """Returns string table as a list."""
+        if (self._strings is None):
+            offsets = self.column('string_offsets').tolist()
+            data = self.column('strings').tostring()
+            self._strings = [data[offsets[i]:offsets[i + 1]]
+                             for i in xrange(len(offsets) - 1)]
+        return self._strings
+
+    def exit_policies(self):
+        """Returns list of CompiledExitPolicy objects indexed by row in
+        policy columns. Policies already seen in earlier files are reused."""
+        strings = self.strings()
+        first_rules = self.column('policy_first_rule').tolist()
+        num_rules = self.column('policy_num_rules').tolist()
+        exiting_alloweds = self.column('policy_exiting_allowed').tolist()
+        rule_texts = self.column('policy_rule_text').tolist()
+        rules_data = self.column('policy_rules').tostring()
+        policies = []
+        for i, first_rule in enumerate(first_rules):
+            key = (rules_data[first_rule * _RULE.size:
+                              (first_rule + num_rules[i]) * _RULE.size],
+                   bool(exiting_alloweds[i]))
+            policy = _compiled_policy_cache.pop(key, None)
+            if (policy is None):
+                rules = []
+                for j in xrange(num_rules[i]):
+                    is_accept, address_type, masked_bits, min_port, \
+                        max_port, address, mask = \
+                        _RULE.unpack_from(key[0], j * _RULE.size)
+                    rules.append(CompiledExitPolicyRule(bool(is_accept),
+                        address_type, None if (masked_bits == _NO_MASKED_BITS) \
+                            else masked_bits, min_port, max_port, address, mask,
+                        strings[rule_texts[first_rule + j]]))
+                policy = CompiledExitPolicy(tuple(rules), key[1])
+                if (len(_compiled_policy_cache) >= _COMPILED_POLICY_CACHE_MAX):
+                    _compiled_policy_cache.popitem(last=False)
+            # (re)insert as most recently used
+            _compiled_policy_cache[key] = policy
+            policies.append(policy)
+        return policies
+
+    def get_network_state(self):
+        """Returns (NetworkStatusDocument, descriptors dict, hibernating
+        statuses list), i.e. the same objects stored in a pickle-format NSF."""
+        if self.is_delta:
+            raise ValueError('Delta network state file needs the state it is \
+relative to: use NetworkStateReader.')
+        return self._decode()
+
+    def apply_delta(self, consensus, descriptors):
+        """Updates consensus and descriptors, the network state of the NSF
+        this delta is relative to, in place to the state of this NSF.
+        Returns hibernating statuses list."""
+        if (not self.is_delta):
+            raise ValueError('Not a delta network state file.')
+        if (pathsim.timestamp(consensus.valid_after) != \
+                self.meta['base_valid_after']):
+            raise ValueError('Delta network state file for {0} is relative to \
+{1}, not {2}.'.format(self.valid_after, self.meta['base_valid_after'],
+                      pathsim.timestamp(consensus.valid_after)))
+        changes, new_descriptors, hibernating_statuses = self._decode()
+        for fprint in self.fingerprints('removed_fingerprint'):
+            del consensus.relays[fprint]
+        consensus.relays.update(changes.relays)
+        for fprint in self.fingerprints('removed_desc_fingerprint'):
+            del descriptors[fprint]
+        descriptors.update(new_descriptors)
+        consensus.valid_after = changes.valid_after
+        consensus.fresh_until = changes.fresh_until
+        consensus.bandwidth_weights = changes.bandwidth_weights
+        consensus.bwweightscale = changes.bwweightscale
+        return hibernating_statuses
+
+    def _decode(self):
+        """Returns the network state objects for the rows in this file."""
+        strings = self.strings()
+        flag_names = self.meta['flag_names']
+
+        # descriptors
+        desc_fprints = self.fingerprints('desc_fingerprint')
+        desc_nicknames = self.column('desc_nickname').tolist()
+        addresses = self.column('address').tolist()
+        hibernatings = self.column('hibernating').tolist()
+        families = self.column('family').tolist()
+        exit_policies = self.column('exit_policy').tolist()
+        ntor_onion_keys = self.column('ntor_onion_key').tolist()
+        if (self.version == 1):
+            policies = None
+        else:
+            policies = self.exit_policies()
+        descriptors = {}
+        for i, fprint in enumerate(desc_fprints):
+            family = strings[families[i]]
+            ntor_onion_key = ntor_onion_keys[i]
+            if (policies is None):
+                exit_policy = compile_exit_policy_string(
+                    strings[exit_policies[i]])
+            else:
+                exit_policy = policies[exit_policies[i]]
+            descriptors[fprint] = pathsim.ServerDescriptor(fprint,
+                bool(hibernatings[i]), strings[desc_nicknames[i]],
+                set(family.split()), unpack_address(addresses[i]),
+                exit_policy,
+                None if (ntor_onion_key == NO_ENTRY) else \
+                    strings[ntor_onion_key])
+
+        # relays
+        relay_fprints = self.fingerprints('fingerprint')
+        nicknames = self.column('nickname').tolist()
+        flag_masks = self.column('flags').tolist()
+        bandwidths = self.column('bandwidth').tolist()
+        flags_by_mask = {}
+        flag_bits_by_mask = {}
+        relays = {}
+        for i, fprint in enumerate(relay_fprints):
+            mask = flag_masks[i]
+            if (mask not in flags_by_mask):
+                flags_by_mask[mask] = [flag for j, flag in
+                                       enumerate(flag_names) if (mask & (1 << j))]
+                flag_bits_by_mask[mask] = \
+                    pathsim.get_flag_bits(flags_by_mask[mask])
+            bandwidth = bandwidths[i]
+            relays[fprint] = pathsim.RouterStatusEntry(fprint,
+                strings[nicknames[i]], list(flags_by_mask[mask]),
+                None if (bandwidth == NO_ENTRY) else bandwidth,
+                flag_bits_by_mask[mask])
+
+        consensus = pathsim.NetworkStatusDocument(
+            datetime.datetime.utcfromtimestamp(self.valid_after),
+            datetime.datetime.utcfromtimestamp(self.fresh_until),
+            self.meta['bandwidth_weights'], self.meta['bwweightscale'],
+            relays)
+
+        # hibernating statuses
+        if (self.version < 3):
+            hib_descs = self.column('hib_descriptor').tolist()
+            hib_fprints = [desc_fprints[i] for i in hib_descs]
+        else:
+            hib_fprints = self.fingerprints('hib_fingerprint')
+        hib_values = self.column('hib_value').tolist()
+        hibernating_statuses = [(t, hib_fprints[i], bool(hib_values[i]))
+                                for i, t in
+                                enumerate(self.column('hib_time').tolist())]
+
+        return (consensus, descriptors, hibernating_statuses)
+
+
+def is_columnar_file(path):
+    """Returns if file at path is in columnar NSF format."""
+    with open(path, 'rb') as f:
+        return (f.read(len(NSF_MAGIC)) == NSF_MAGIC)
+
+
+def map_file(path):
+    """Returns read-only mmap of file at path."""
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _open_columnar(path):
+    """Returns (NetworkStateFile, mmap to close after use or None) for
+    columnar NSF at path, which may be an ArchiveEntry, or (None, None) for
+    a pickle-format NSF."""
+    if isinstance(path, ArchiveEntry):
+        return (NetworkStateFile(path.archive.buf, path.offset), None)
+    if is_columnar_file(path):
+        buf = map_file(path)
+        return (NetworkStateFile(buf), buf)
+    return (None, None)
+
+
+def read_network_state_file(path):
+    """Reads NSF in either columnar or pickle format.
+    Returns (consensus, descriptors, hibernating_statuses).
+    Delta NSFs must instead be read with NetworkStateReader."""
+    nsf, buf = _open_columnar(path)
+    if (nsf is not None):
+        try:
+            return nsf.get_network_state()
+        finally:
+            if (buf is not None):
+                buf.close()
+    else:
+        with open(path, 'rb') as nsf:
+            consensus = pickle.load(nsf)
+            descriptors = pickle.load(nsf)
+            hibernating_statuses = pickle.load(nsf)
+        return (consensus, descriptors, hibernating_statuses)
+
+
+def read_network_state_times(path):
+    """Returns (valid_after, fresh_until) timestamps of NSF at path without
+    reading relays or descriptors from columnar files."""
+    if isinstance(path, ArchiveEntry):
+        return (path.valid_after, path.fresh_until)
+    nsf, buf = _open_columnar(path)
+    if (nsf is not None):
+        try:
+            return (nsf.valid_after, nsf.fresh_until)
+        finally:
+            buf.close()
+    else:
+        with open(path, 'rb') as nsf:
+            consensus = pickle.load(nsf)
+        return (pathsim.timestamp(consensus.valid_after),
+                pathsim.timestamp(consensus.fresh_until))
+
+
+class NetworkStateReader(object):
+    """Reads a sequence of NSFs, keeping the network state of the last one
+    so that delta NSFs can be applied to it. NSFs must be read in order,
+    starting at a keyframe (i.e. any non-delta NSF)."""
+
+    def __init__(self):
+        self.consensus = None
+        self.descriptors = None
+
+    def read(self, path):
+        """Reads NSF at path in any format.
+        Returns (consensus, descriptors, hibernating_statuses), which the
+        caller may modify without affecting later deltas."""
+        nsf, buf = _open_columnar(path)
+        if (nsf is not None):
+            try:
+                if nsf.is_delta:
+                    if (self.consensus is None):
+                        raise ValueError('Delta network state file {0} read \
+before a keyframe.'.format(path))
+                    hibernating_statuses = nsf.apply_delta(self.consensus,
+                                                           self.descriptors)
+                    consensus, descriptors = _copy_state(self.consensus,
+                                                         self.descriptors)
+                    return (consensus, descriptors, hibernating_statuses)
+                consensus, descriptors, hibernating_statuses = \
+                    nsf.get_network_state()
+            finally:
+                if (buf is not None):
+                    buf.close()
+        else:
+            consensus, descriptors, hibernating_statuses = \
+                read_network_state_file(path)
+        # keep a copy so that keyframes are returned exactly as decoded
+        self.consensus, self.descriptors = _copy_state(consensus, descriptors)
+        return (consensus, descriptors, hibernating_statuses)
+
+
+def _copy_state(consensus, descriptors):
+    """Returns copies of the containers in (consensus, descriptors), filled in
+    fingerprint order as when decoding a keyframe (so that iteration order,
+    and thus simulation output, doesn't depend on the keyframe interval)."""
+    relays = consensus.relays
+    return (pathsim.NetworkStatusDocument(consensus.valid_after,
+                consensus.fresh_until, dict(consensus.bandwidth_weights),
+                consensus.bwweightscale,
+                dict((fprint, relays[fprint]) for fprint in sorted(relays))),
+            dict((fprint, descriptors[fprint]) for fprint in
+                 sorted(descriptors)))
+
+
+### Network state archive ###
+# An archive stores a month of columnar NSFs (keyframes and deltas) in one
+# file, so that the simulator needn't list and open a file per hour.
+#
+# Layout (all integers little-endian):
+#   header: magic (8 bytes), format version (uint32), index offset (uint64),
+#       index length (uint64)
+#   records: columnar NSFs in time order, each starting on an 8-byte boundary
+#   index: pickled list with a (valid_after, fresh_until, record offset,
+#       keyframe) tuple per record, where keyframe is the position in the list
+#       of the keyframe that the record's delta chain starts from
+
+ARCHIVE_MAGIC = 'TORPSNSA'
+ARCHIVE_VERSION = 1
+ARCHIVE_EXTENSION = '.nsfa'
+
+_ARCHIVE_HEADER = struct.Struct('<8sIQQ')
+
+
+class NetworkStateArchiveWriter(object):
+    """Writes NSFs in time order into an archive."""
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'wb')
+        self.f.write('\0' * _align(_ARCHIVE_HEADER.size))
+        self.index = []
+        self.keyframe = None
+
+    def add(self, consensus, descriptors, hibernating_statuses, base=None):
+        """Appends network state, as a delta against base (see
+        encode_network_state()) if given."""
+        valid_after = pathsim.timestamp(consensus.valid_after)
+        if (self.index) and (valid_after <= self.index[-1][0]):
+            raise ValueError('Network state for {0} added to archive {1} out \
+of time order.'.format(valid_after, self.path))
+        if (base is None):
+            self.keyframe = len(self.index)
+        elif (self.keyframe is None):
+            raise ValueError('Delta added to archive {0} before a keyframe.'. \
+                             format(self.path))
+        data = encode_network_state(consensus, descriptors,
+                                    hibernating_statuses, base)
+        self.index.append((valid_after,
+                           pathsim.timestamp(consensus.fresh_until),
+                           self.f.tell(), self.keyframe))
+        self.f.write(data + '\0' * (_align(len(data)) - len(data)))
+
+    def close(self):
+        """Writes index and header, and closes archive."""
+        index_data = pickle.dumps(self.index, pickle.HIGHEST_PROTOCOL)
+        index_offset = self.f.tell()
+        self.f.write(index_data)
+        self.f.seek(0)
+        self.f.write(_ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION,
+                                          index_offset, len(index_data)))
+        self.f.close()
+
+
+class ArchiveEntry(str):
+    """Names an NSF inside an archive as if the archive were a directory, so
+    that its basename is that of the NSF written as a separate file. Can be
+    used wherever an NSF filename can."""
+
+    def __new__(cls, archive, position, valid_after, fresh_until, offset,
+                keyframe):
+        name = datetime.datetime.utcfromtimestamp(valid_after).strftime(
+            NSF_NAME_FORMAT)
+        entry = str.__new__(cls, os.path.join(archive.path, name))
+        entry.archive = archive
+        entry.position = position
+        entry.valid_after = valid_after
+        entry.fresh_until = fresh_until
+        entry.offset = offset
+        entry.keyframe = keyframe
+        return entry
+
+
+class NetworkStateArchive(object):
+    """Network state archive read in place from an mmap."""
+
+    def __init__(self, path):
+        self.path = path
+        self.buf = map_file(path)
+        magic, version, index_offset, index_len = \
+            _ARCHIVE_HEADER.unpack_from(self.buf, 0)
+        if (magic != ARCHIVE_MAGIC):
+            raise ValueError('Not a network state archive: {0}'.format(path))
+        if (version != ARCHIVE_VERSION):
+            raise ValueError('Unsupported network state archive version: \
+{0}'.format(version))
+        index = pickle.loads(self.buf[index_offset:index_offset + index_len])
+        self.entries = [ArchiveEntry(self, i, *record)
+                        for i, record in enumerate(index)]
+        self.valid_afters = [entry.valid_after for entry in self.entries]
+
+    def find(self, valid_after):
+        """Returns ArchiveEntry for NSF with given valid_after timestamp."""
+        i = bisect.bisect_left(self.valid_afters, valid_after)
+        if (i == len(self.valid_afters)) or \
+                (self.valid_afters[i] != valid_after):
+            raise KeyError('No network state for {0} in archive {1}.'. \
+                           format(valid_after, self.path))
+        return self.entries[i]
+
+    def read_network_state(self, valid_after):
+        """Returns (consensus, descriptors, hibernating_statuses) of NSF with
+        given valid_after timestamp, applying the deltas from its keyframe."""
+        entry = self.find(valid_after)
+        nsf_reader = NetworkStateReader()
+        for prev_entry in self.entries[entry.keyframe:entry.position]:
+            nsf_reader.read(prev_entry)
+        return nsf_reader.read(entry)
+
+    def close(self):
+        self.buf.close()
+
+
+### Manifest ###
+# Each directory of NSFs written by the process command also gets a manifest,
+# so that the simulator can find NSFs and their times without reading them.
+# Its name starts with '.', so it is skipped when listing NSFs. It is a
+# pickled dict with:
+#   version: MANIFEST_VERSION
+#   files: SHA-1 hex digest by name of each NSF or archive file
+#   network_states: list of (name, valid_after, fresh_until, num_relays,
+#       num_descriptors, filename) in time order, where name is the NSF
+#       basename and filename that of the file containing it (an archive or
+#       the NSF itself)
+# Missing consensus hours are not listed, as the simulator finds them from the
+# network state times (see pathsim.pad_network_state_files()).
+
+MANIFEST_NAME = '.nsf_manifest'
+MANIFEST_VERSION = 1
+
+
+def file_sha1(path):
+    """Returns SHA-1 hex digest of file at path."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1 << 20)
+            if (not data):
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def write_manifest(dir_path, network_states):
+    """Writes manifest for files in dir_path. network_states is a list of
+    (name, valid_after, fresh_until, num_relays, num_descriptors, filename) in
+    time order."""
+    files = {}
+    for network_state in network_states:
+        filename = network_state[5]
+        if (filename not in files):
+            files[filename] = file_sha1(os.path.join(dir_path, filename))
+    manifest = {'version': MANIFEST_VERSION,
+                'files': files,
+                'network_states': network_states}
+    with open(os.path.join(dir_path, MANIFEST_NAME), 'wb') as f:
+        pickle.dump(manifest, f, pickle.HIGHEST_PROTOCOL)
+
+
+def read_manifest(dir_path):
+    """Returns manifest dict for dir_path, or None if it has no manifest."""
+    path = os.path.join(dir_path, MANIFEST_NAME)
+    if (not os.path.exists(path)):
+        return None
+    with open(path, 'rb') as f:
+        manifest = pickle.load(f)
+    if (manifest['version'] != MANIFEST_VERSION):
+        raise ValueError('Unsupported network state manifest version: {0}'. \
+                         format(manifest['version']))
+    return manifest
+
+
+def verify_manifest(dir_path, manifest):
+    """Returns names of files in manifest for dir_path whose contents don't
+    match their checksums."""
+    return [filename for filename, digest in sorted(manifest['files'].items())
+            if (file_sha1(os.path.join(dir_path, filename)) != digest)]
@@ -2,7 +2,6 @@ import datetime
 import os
 import os.path
 from stem import Flag
-from stem.exit_policy import ExitPolicy
 import random as rand
 import sys
 import collections
@@ -12,16 +11,46 @@ from models import *
 import congestion_aware_pathsim
 # import vcs_pathsim
 import process_consensuses
+import nsf_format
 import re
 import network_modifiers
 import event_callbacks
 import importlib
 import logging
+import threading
+import Queue
+import hashlib
+import multiprocessing
+import tempfile
+import shutil
+import socket
+import struct
+import bisect
+import gzip
+import itertools
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 logger = logging.getLogger(__name__)
 _testing = False  # True
 
-GUARD_SAMPLED_INDEX = 0
+# bits set in RouterStatusEntry.flag_bits for the relay flags it has
+# (bits are assigned here rather than by stem's Flag order, which may change)
+FLAG_BITS = dict((flag, 1 << i) for i, flag in enumerate((Flag.AUTHORITY,
+    Flag.BADEXIT, Flag.BADDIRECTORY, Flag.EXIT, Flag.FAST, Flag.GUARD,
+    Flag.HSDIR, Flag.NAMED, Flag.RUNNING, Flag.STABLE, Flag.UNNAMED,
+    Flag.V2DIR, Flag.VALID, 'NoEdConsensus', 'StaleDesc', 'V3Dir')))
+BADEXIT_BIT = FLAG_BITS[Flag.BADEXIT]
+EXIT_BIT = FLAG_BITS[Flag.EXIT]
+FAST_BIT = FLAG_BITS[Flag.FAST]
+GUARD_BIT = FLAG_BITS[Flag.GUARD]
+RUNNING_BIT = FLAG_BITS[Flag.RUNNING]
+STABLE_BIT = FLAG_BITS[Flag.STABLE]
+VALID_BIT = FLAG_BITS[Flag.VALID]
+RUNNING_GUARD_BITS = RUNNING_BIT | GUARD_BIT
+GUARD_FILTER_BITS = RUNNING_BIT | VALID_BIT | GUARD_BIT
 
 
 class TorOptions:
@@ -68,13 +97,24 @@ class TorOptions:
     # from #define MAX_POPULATE_ATTEMPTS 32 in circuicbuild.c
     max_populate_attempts = 32
 
+    # prefix lengths of subnets in which only one relay is used per circuit
+    # given by EnforceDistinctSubnets in Tor (default: /16 IPv4, /32 IPv6)
+    # used for ServerDescriptor.subnet, so set before loading network states
+    subnet_prefix_bits = 16
+    subnet_prefix_bits_ipv6 = 32
 
-class NetworkState:
+
+class NetworkState(object):
     """Contains Tor network state in a consensus period needed to run
     simulation."""
-
-    def __init__(self, cons_valid_after, cons_fresh_until, cons_bw_weights,
-                 cons_bwweightscale, cons_rel_stats, hibernating_statuses, descriptors):
+    __slots__ = ('cons_valid_after', 'cons_fresh_until', 'cons_bw_weights',
+                 'cons_bwweightscale', 'cons_rel_stats', 'hibernating_statuses',
+                 'descriptors')
+
+    def __init__(self, cons_valid_after=None, cons_fresh_until=None,
+                 cons_bw_weights=None, cons_bwweightscale=None,
+                 cons_rel_stats=None, hibernating_statuses=None,
+                 descriptors=None):
         self.cons_valid_after = cons_valid_after
         self.cons_fresh_until = cons_fresh_until
         self.cons_bw_weights = cons_bw_weights
@@ -83,55 +123,320 @@ class NetworkState:
         self.hibernating_statuses = hibernating_statuses
         self.descriptors = descriptors
 
+    def __getstate__(self):
+        return _get_slots_state(self)
 
-class RouterStatusEntry:
+    def __setstate__(self, state):
+        _set_slots_state(self, state)
+
+
+class RelayIdTable(object):
+    """Run-wide table of dense integer IDs for relay fingerprints, which key
+    the relays in all simulation state. Fingerprints are only used again at
+    the callback (i.e. output) boundary."""
+
+    def __init__(self):
+        self.ids = {}
+        self.fingerprints = []
+
+    def add_fingerprints(self, fprints):
+        """Assigns IDs to new fingerprints in fprints, in sorted order so
+        that IDs do not depend on dict order."""
+        ids = self.ids
+        fingerprints = self.fingerprints
+        for fprint in sorted(set(fprint for fprint in fprints
+                                 if (fprint not in ids))):
+            ids[fprint] = len(fingerprints)
+            fingerprints.append(fprint)
+
+    def convert_network_state(self, network_state):
+        """Returns copy of NetworkState with relays keyed by ID rather than
+        by fingerprint."""
+        self.add_fingerprints(network_state.descriptors)
+        self.add_fingerprints(network_state.cons_rel_stats)
+        self.add_fingerprints(hs[1] for hs in
+                              network_state.hibernating_statuses)
+        ids = self.ids
+        cons_rel_stats = dict((ids[fprint], rel_stat) for fprint, rel_stat in
+                              network_state.cons_rel_stats.iteritems())
+        descriptors = dict((ids[fprint], desc) for fprint, desc in
+                           network_state.descriptors.iteritems())
+        hibernating_statuses = [(hs[0], ids[hs[1]], hs[2]) for hs in
+                                network_state.hibernating_statuses]
+        return NetworkState(network_state.cons_valid_after,
+                            network_state.cons_fresh_until,
+                            network_state.cons_bw_weights,
+                            network_state.cons_bwweightscale, cons_rel_stats,
+                            hibernating_statuses, descriptors)
+
+    def get_fingerprint_circuit(self, circuit):
+        """Returns copy of circuit with path of fingerprints."""
+        fingerprints = self.fingerprints
+        circuit = dict(circuit)
+        circuit['path'] = tuple(fingerprints[relay] for relay in
+                                circuit['path'])
+        return circuit
+
+
+class FingerprintView(collections.Mapping):
+    """Read-only view of a dict with RelayIdTable ID keys (e.g. consensus
+    statuses or descriptors) as a dict with fingerprint keys."""
+
+    def __init__(self, relays, relay_ids):
+        self.relays = relays
+        self.relay_ids = relay_ids
+
+    def __getitem__(self, fprint):
+        return self.relays[self.relay_ids.ids[fprint]]
+
+    def __contains__(self, fprint):
+        ids = self.relay_ids.ids
+        return (fprint in ids) and (ids[fprint] in self.relays)
+
+    def __iter__(self):
+        fingerprints = self.relay_ids.fingerprints
+        for relay in self.relays:
+            yield fingerprints[relay]
+
+    def __len__(self):
+        return len(self.relays)
+
+
+class FingerprintCallbacks(object):
+    """Gives callbacks object (cf. event_callbacks module) relays by
+    fingerprint, while the simulation passes them by RelayIdTable ID."""
+
+    def __init__(self, callbacks, relay_ids):
+        self.callbacks = callbacks
+        self.relay_ids = relay_ids
+
+    def __getattr__(self, name):
+        return getattr(self.callbacks, name)
+
+    def set_network_state(self, cons_valid_after, cons_fresh_until,
+                          cons_bw_weights, cons_bwweightscale, cons_rel_stats,
+                          descriptors):
+        self.callbacks.set_network_state(cons_valid_after, cons_fresh_until,
+            cons_bw_weights, cons_bwweightscale,
+            FingerprintView(cons_rel_stats, self.relay_ids),
+            FingerprintView(descriptors, self.relay_ids))
+
+    def set_sample_id(self, id):
+        self.callbacks.set_sample_id(id)
+
+    def circuit_creation(self, circuit):
+        self.callbacks.circuit_creation(
+            self.relay_ids.get_fingerprint_circuit(circuit))
+
+    def stream_assignment(self, stream, circuit):
+        self.callbacks.stream_assignment(stream,
+            self.relay_ids.get_fingerprint_circuit(circuit))
+
+
+class WarmupCallbacks(object):
+    """Gives callbacks object (cf. event_callbacks module) only the circuits
+    and streams from start_time on, so that the simulation before it just
+    warms up client state."""
+
+    def __init__(self, callbacks, start_time):
+        self.callbacks = callbacks
+        self.start_time = start_time
+
+    def __getattr__(self, name):
+        return getattr(self.callbacks, name)
+
+    def circuit_creation(self, circuit):
+        if (circuit['time'] >= self.start_time):
+            self.callbacks.circuit_creation(circuit)
+
+    def stream_assignment(self, stream, circuit):
+        if (stream['time'] >= self.start_time):
+            self.callbacks.stream_assignment(stream, circuit)
+
+
+class DescriptorStore(dict):
+    """Descriptors of relays seen during simulation, with relay ID keys (see
+    RelayIdTable) and ServerDescriptor values. Relays not seen for longer than
+    max_age are forgotten unless still referenced (e.g. as client guards).
+    Also indexes the families of the stored relays (see in_same_family()):
+    families maps each relay in a family with another stored relay to the set
+    of such relays."""
+
+    def __init__(self, max_age):
+        dict.__init__(self)
+        self.max_age = max_age
+        self.last_seen = {}
+        self.num_evicted = 0
+        self.max_size = 0
+        self.families = {}
+        # family entries (e.g. '$fingerprint' or nickname) to relays listing them
+        self.family_listers = {}
+
+    def add_seen(self, new_descriptors, seen_time):
+        """Adds new_descriptors and records their relays as seen at
+        seen_time."""
+        changed = []
+        for relay, desc in new_descriptors.iteritems():
+            old_desc = self.get(relay)
+            if (old_desc is not desc) and ((old_desc is None) or
+                    (old_desc.nickname != desc.nickname) or
+                    (old_desc.family != desc.family)):
+                changed.append(relay)
+        for relay in changed:
+            if (relay in self):
+                self.remove_family(relay)
+        self.update(new_descriptors)
+        for relay in changed:
+            self.add_family(relay)
+        last_seen = self.last_seen
+        for fprint in new_descriptors:
+            last_seen[fprint] = seen_time
+        self.max_size = max(self.max_size, len(self))
+
+    def add_family(self, relay):
+        """Adds family of stored relay to the family index."""
+        desc = self[relay]
+        family = desc.family
+        family_listers = self.family_listers
+        for member in family:
+            if (member in family_listers):
+                family_listers[member].add(relay)
+            else:
+                family_listers[member] = set([relay])
+        # add relays that list this one and that this one lists
+        families = self.families
+        for name in ('$' + desc.fingerprint, desc.nickname):
+            for other in family_listers.get(name, ()):
+                if (other == relay):
+                    continue
+                other_desc = self[other]
+                if (('$' + other_desc.fingerprint) in family) or \
+                        (other_desc.nickname in family):
+                    if (relay in families):
+                        families[relay].add(other)
+                    else:
+                        families[relay] = set([other])
+                    if (other in families):
+                        families[other].add(relay)
+                    else:
+                        families[other] = set([relay])
+
+    def remove_family(self, relay):
+        """Removes family of stored relay from the family index."""
+        family_listers = self.family_listers
+        for member in self[relay].family:
+            listers = family_listers[member]
+            listers.discard(relay)
+            if (not listers):
+                del family_listers[member]
+        families = self.families
+        for other in families.pop(relay, ()):
+            families[other].discard(relay)
+            if (not families[other]):
+                del families[other]
+
+    def evict(self, cur_time, get_referenced):
+        """Removes descriptors of relays last seen more than max_age before
+        cur_time, except for relays in the set returned by
+        get_referenced(), which is only called if there are candidates.
+        Returns number of descriptors removed."""
+        min_seen_time = cur_time - self.max_age
+        candidates = [fprint for fprint, seen_time in
+                      self.last_seen.iteritems() if (seen_time < min_seen_time)]
+        if (not candidates):
+            return 0
+        referenced = get_referenced()
+        num_evicted = 0
+        for fprint in candidates:
+            if (fprint not in referenced):
+                self.remove_family(fprint)
+                del self[fprint]
+                del self.last_seen[fprint]
+                num_evicted += 1
+        self.num_evicted += num_evicted
+        return num_evicted
+
+
+class RouterStatusEntry(object):
     """
     Represents a relay entry in a consensus document.
     Slim version of stem.descriptor.router_status_entry.RouterStatusEntry.
     """
+    __slots__ = ('fingerprint', 'nickname', 'flags', 'bandwidth', 'flag_bits')
 
-    def __init__(self, fingerprint, nickname, flags, bandwidth):
-        self.fingerprint = fingerprint
-        self.nickname = nickname
+    def __init__(self, fingerprint=None, nickname=None, flags=(),
+                 bandwidth=None, flag_bits=None):
+        self.fingerprint = intern_str(fingerprint)
+        self.nickname = intern_str(nickname)
         self.flags = flags
         self.bandwidth = bandwidth
+        if (flag_bits is None):
+            flag_bits = get_flag_bits(flags)
+        self.flag_bits = flag_bits
 
+    def __getstate__(self):
+        """Pickles without flag_bits, which depend on FLAG_BITS."""
+        state = _get_slots_state(self)
+        del state['flag_bits']
+        return state
+
+    def __setstate__(self, state):
+        """Recomputes flag_bits, which older pickles also lack."""
+        _set_slots_state(self, state)
+        self.fingerprint = intern_str(self.fingerprint)
+        self.nickname = intern_str(self.nickname)
+        self.flag_bits = get_flag_bits(self.flags)
 
-class NetworkStatusDocument:
+
+class NetworkStatusDocument(object):
     """
     Represents a consensus document.
     Slim version of stem.descriptor.networkstatus.NetworkStatusDocument.
     """
+    __slots__ = ('valid_after', 'fresh_until', 'bandwidth_weights',
+                 'bwweightscale', 'relays')
 
-    def __init__(self, valid_after, fresh_until, bandwidth_weights, \
-                 bwweightscale, relays):
+    def __init__(self, valid_after=None, fresh_until=None,
+                 bandwidth_weights=None, bwweightscale=None, relays=None):
         self.valid_after = valid_after
         self.fresh_until = fresh_until
         self.bandwidth_weights = bandwidth_weights
         self.bwweightscale = bwweightscale
         self.relays = relays
 
+    def __getstate__(self):
+        return _get_slots_state(self)
 
-class ServerDescriptor:
+    def __setstate__(self, state):
+        _set_slots_state(self, state)
+
+
+class ServerDescriptor(object):
     """
     Represents a server descriptor.
     Slim version of stem.descriptor.server_descriptor.ServerDescriptor combined
     with stem.descriptor.server_descriptor.RelayDescriptor.
     """
+    __slots__ = ('fingerprint', 'hibernating', 'nickname', 'family', 'address',
+                 'exit_policy', 'ntor_onion_key', 'subnet')
 
-    def __init__(self, fingerprint, hibernating, nickname, family, address,
-                 exit_policy, ntor_onion_key):
-        self.fingerprint = fingerprint
+    def __init__(self, fingerprint=None, hibernating=None, nickname=None,
+                 family=(), address=None, exit_policy=None,
+                 ntor_onion_key=None):
+        self.fingerprint = intern_str(fingerprint)
         self.hibernating = hibernating
-        self.nickname = nickname
-        self.family = family
+        self.nickname = intern_str(nickname)
+        self.family = set(intern_str(member) for member in family)
         self.address = address
         self.exit_policy = exit_policy
         self.ntor_onion_key = ntor_onion_key
+        self.subnet = get_subnet(address)
 
     def __getstate__(self):
         """Used for headache-free pickling. Turns ExitPolicy into its string
-        representation, rather than using the repeatedly problematic object."""
+        representation, rather than using the repeatedly problematic object.
+        Compiled exit policies are pickled as they are. The subnet is
+        recomputed when unpickling."""
 
         state = dict()
         state['fingerprint'] = self.fingerprint
@@ -139,22 +444,540 @@ class ServerDescriptor:
         state['nickname'] = self.nickname
         state['family'] = self.family
         state['address'] = self.address
-        state['exit_policy'] = str(self.exit_policy)
+        if isinstance(self.exit_policy, nsf_format.CompiledExitPolicy):
+            state['exit_policy'] = self.exit_policy
+        else:
+            state['exit_policy'] = str(self.exit_policy)
         state['ntor_onion_key'] = self.ntor_onion_key
 
         return state
 
     def __setstate__(self, state):
-        """Used for headache-free unpickling. Creates ExitPolicy from string
-        representation."""
+        """Used for headache-free unpickling. Compiles ExitPolicy from string
+        representation, sharing the compiled policy with other relays with
+        the same one."""
 
-        self.fingerprint = state['fingerprint']
+        self.fingerprint = intern_str(state['fingerprint'])
         self.hibernating = state['hibernating']
-        self.nickname = state['nickname']
-        self.family = state['family']
+        self.nickname = intern_str(state['nickname'])
+        self.family = set(intern_str(member) for member in state['family'])
         self.address = state['address']
-        self.exit_policy = ExitPolicy(*state['exit_policy'].split(', '))
+        if isinstance(state['exit_policy'], basestring):
+            self.exit_policy = nsf_format.compile_exit_policy_string(
+                state['exit_policy'])
+        else:
+            self.exit_policy = state['exit_policy']
         self.ntor_onion_key = state['ntor_onion_key']
+        self.subnet = get_subnet(self.address)
+
+
+class WeightedSampler(object):
+    """Selects nodes randomly in proportion to their weights in O(1) time
+    using the alias method (Vose's version). Built once per consensus for
+    each list of nodes that are selected from repeatedly. The simulator
+    samples with ConditionalSampler; this is kept for get_weighted_nodes(),
+    which vcs_pathsim uses."""
+    __slots__ = ('nodes', 'probs', 'aliases')
+
+    def __init__(self, nodes, weights):
+        """Takes list of nodes and weights (as a dict)."""
+        total_weight = 0
+        for node in nodes:
+            total_weight += weights[node]
+        if (total_weight == 0):
+            raise ValueError('ERROR: Node list has total weight zero.')
+        num_nodes = len(nodes)
+        self.nodes = list(nodes)
+        # scale weights to average 1
+        probs = [weights[node] * num_nodes / total_weight for node in nodes]
+        aliases = list(self.nodes)
+        small = [i for i in xrange(num_nodes) if (probs[i] < 1)]
+        large = [i for i in xrange(num_nodes) if (probs[i] >= 1)]
+        # fill the column of each small node with a large node
+        while small and large:
+            i = small.pop()
+            j = large.pop()
+            aliases[i] = self.nodes[j]
+            probs[j] -= 1 - probs[i]
+            if (probs[j] < 1):
+                small.append(j)
+            else:
+                large.append(j)
+        # remaining columns are full, up to rounding error
+        for i in small:
+            probs[i] = 1
+        for i in large:
+            probs[i] = 1
+        self.probs = probs
+        self.aliases = aliases
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def select(self, rng=rand):
+        """Returns node randomly selected using rng (see
+        get_sample_rng())."""
+        x = rng.random() * len(self.nodes)
+        i = int(x)
+        if ((x - i) < self.probs[i]):
+            return self.nodes[i]
+        else:
+            return self.aliases[i]
+
+
+class FenwickTree(object):
+    """Binary indexed tree over a list of non-negative weights, giving prefix
+    sums, the position of a cumulative weight, and weight changes in O(log n)
+    time."""
+    __slots__ = ('weights', 'tree', 'total')
+
+    def __init__(self, weights):
+        self.weights = list(weights)
+        num_weights = len(self.weights)
+        tree = [0] + self.weights
+        for i in xrange(1, num_weights + 1):
+            j = i + (i & -i)
+            if (j <= num_weights):
+                tree[j] += tree[i]
+        self.tree = tree
+        self.total = sum(self.weights)
+
+    def set(self, i, weight):
+        """Sets weight at position i."""
+        delta = weight - self.weights[i]
+        if (delta == 0):
+            return
+        self.weights[i] = weight
+        self.total += delta
+        tree = self.tree
+        num_weights = len(tree) - 1
+        i += 1
+        while (i <= num_weights):
+            tree[i] += delta
+            i += (i & -i)
+
+    def prefix_sum(self, i):
+        """Returns sum of the first i weights."""
+        tree = self.tree
+        total = 0
+        while (i > 0):
+            total += tree[i]
+            i -= (i & -i)
+        return total
+
+    def find(self, x):
+        """Returns smallest position whose weight takes the cumulative weight
+        above x, i.e. that is selected by x in [0, total), or len(weights) if
+        there is none."""
+        tree = self.tree
+        num_weights = len(tree) - 1
+        pos = 0
+        step = 1
+        while (step * 2 <= num_weights):
+            step *= 2
+        while (step > 0):
+            next_pos = pos + step
+            if (next_pos <= num_weights) and (tree[next_pos] <= x):
+                pos = next_pos
+                x -= tree[next_pos]
+            step //= 2
+        return pos
+
+
+class ConditionalSampler(object):
+    """Selects nodes randomly in proportion to their weights, conditioned on
+    nodes having given flags and not conflicting with given relays, i.e. not
+    being the same relay or in the same family or subnet, as Tor requires of
+    relays in a circuit and of a client's guards. The weight of conflicting
+    nodes is skipped over in the cumulative weights, so selection takes one
+    draw rather than drawing until a suitable node is found, with the same
+    distribution. Nodes can also be disabled (e.g. while hibernating) and
+    enabled again in O(log n) time."""
+
+    def __init__(self, nodes, weights, cons_rel_stats, descriptors):
+        """Takes list of nodes and weights (as a dict or list indexed by
+        relay ID), and the cons_rel_stats and descriptors with their flags,
+        families, and subnets."""
+        self.nodes = list(nodes)
+        self.positions = dict((node, i) for i, node in enumerate(self.nodes))
+        self.weights = [weights[node] for node in self.nodes]
+        self.flag_bits = [cons_rel_stats[node].flag_bits for node in self.nodes]
+        self.descriptors = descriptors
+        # subnets to node positions, created when first needed
+        self.subnets = None
+        # trees of weights of enabled nodes with given flag bits
+        self.trees = {}
+        self.disabled = set()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get_tree(self, required_bits):
+        """Returns FenwickTree of weights zeroed for nodes without all of
+        required_bits and for disabled nodes."""
+        if (required_bits not in self.trees):
+            disabled = self.disabled
+            self.trees[required_bits] = FenwickTree(
+                [weight if (((flag_bits & required_bits) == required_bits) and
+                            (i not in disabled)) else 0
+                 for i, (weight, flag_bits) in
+                 enumerate(zip(self.weights, self.flag_bits))])
+        return self.trees[required_bits]
+
+    def disable(self, node):
+        """Excludes node, if present, from selection."""
+        i = self.positions.get(node)
+        if (i is None) or (i in self.disabled):
+            return
+        self.disabled.add(i)
+        for tree in self.trees.itervalues():
+            tree.set(i, 0)
+
+    def enable(self, node):
+        """Includes disabled node, if present, in selection again."""
+        i = self.positions.get(node)
+        if (i is None) or (i not in self.disabled):
+            return
+        self.disabled.discard(i)
+        for required_bits, tree in self.trees.iteritems():
+            if ((self.flag_bits[i] & required_bits) == required_bits):
+                tree.set(i, self.weights[i])
+
+    def get_conflicts(self, relays):
+        """Returns set of positions of nodes that conflict with relays."""
+        positions = self.positions
+        descriptors = self.descriptors
+        families = getattr(descriptors, 'families', None)
+        conflicts = set()
+        if (self.subnets is None):
+            self.subnets = {}
+            for i, node in enumerate(self.nodes):
+                subnet = descriptors[node].subnet
+                if (subnet in self.subnets):
+                    self.subnets[subnet].append(i)
+                else:
+                    self.subnets[subnet] = [i]
+        for relay in relays:
+            if (relay in positions):
+                conflicts.add(positions[relay])
+            if (families is not None):
+                for member in families.get(relay, ()):
+                    if (member in positions):
+                        conflicts.add(positions[member])
+            else:
+                for i, node in enumerate(self.nodes):
+                    if in_same_family(descriptors, relay, node):
+                        conflicts.add(i)
+            conflicts.update(self.subnets.get(descriptors[relay].subnet, ()))
+        return conflicts
+
+    def select(self, conflicting=(), required_bits=0, rng=rand):
+        """Returns node randomly selected using rng that has required_bits set
+        in its flag_bits and doesn't conflict with any relay in
+        conflicting."""
+        tree = self.get_tree(required_bits)
+        weights = tree.weights
+        if conflicting:
+            conflicts = set(i for i in self.get_conflicts(conflicting)
+                            if (weights[i] > 0))
+        else:
+            conflicts = set()
+        excluded = sorted(conflicts)
+        total_weight = tree.total - sum(weights[i] for i in excluded)
+        if (total_weight <= 0):
+            raise ValueError('ERROR: No node can be selected.')
+        while True:
+            # skip over weights of excluded nodes below the selected weight
+            x = rng.random() * total_weight
+            for i in excluded:
+                if (tree.prefix_sum(i) <= x):
+                    x += weights[i]
+                else:
+                    break
+            i = tree.find(x)
+            # rounding error can put x at an excluded node or past the end
+            if (i < len(weights)) and (i not in conflicts) and \
+                    (weights[i] > 0):
+                return self.nodes[i]
+
+
+class HibernatingStatus(dict):
+    """Hibernating status of relays, with relay ID keys and bool values, that
+    disables hibernating relays in the samplers added to it."""
+
+    def __init__(self):
+        dict.__init__(self)
+        self.samplers = []
+
+    def set_status(self, relay, hibernating):
+        """Sets status of relay and enables or disables it in samplers."""
+        self[relay] = hibernating
+        for sampler in self.samplers:
+            if hibernating:
+                sampler.disable(relay)
+            else:
+                sampler.enable(relay)
+
+    def add_sampler(self, sampler):
+        """Disables hibernating relays in ConditionalSampler and keeps it
+        updated until remove_samplers() is called."""
+        disable_hibernating(sampler, self)
+        self.samplers.append(sampler)
+
+    def remove_samplers(self):
+        self.samplers = []
+
+
+class GuardList(dict):
+    """Guards of a client, with relay ID keys and guard state values, that
+    keeps the guards ordered by sampled index and the set of bad guards.
+    next_index is the sampled index to give the next guard added."""
+
+    def __init__(self):
+        dict.__init__(self)
+        self.order = []
+        self.bad = set()
+        self.next_index = 0
+
+    def __reduce__(self):
+        # add guards through __setitem__() when unpickling
+        return (GuardList, (), {'next_index': self.next_index}, None,
+                self.iteritems())
+
+    def __setitem__(self, guard, guard_props):
+        if (guard in self):
+            self.order.remove(guard)
+        dict.__setitem__(self, guard, guard_props)
+        # guards are almost always added in order of sampled index
+        i = len(self.order)
+        while (i > 0) and \
+                (self[self.order[i - 1]]['index'] > guard_props['index']):
+            i -= 1
+        self.order.insert(i, guard)
+        if (guard_props['bad_since'] == None):
+            self.bad.discard(guard)
+        else:
+            self.bad.add(guard)
+        self.next_index = max(self.next_index, guard_props['index'] + 1)
+
+    def __delitem__(self, guard):
+        dict.__delitem__(self, guard)
+        self.order.remove(guard)
+        self.bad.discard(guard)
+
+    def set_bad_since(self, guard, bad_since):
+        """Sets time guard went bad, or None if it is not bad."""
+        self[guard]['bad_since'] = bad_since
+        if (bad_since == None):
+            self.bad.discard(guard)
+        else:
+            self.bad.add(guard)
+
+    def num_live(self, descriptors, circ_time):
+        """Returns number of guards that are not bad, have a descriptor, and
+        are not unreachable unless it is time to retry them."""
+        num = 0
+        for guard in self.order:
+            if (guard not in self.bad) and (guard in descriptors) and \
+                    ((self[guard]['unreachable_since'] == None) or \
+                     guard_is_time_to_retry(self[guard], circ_time)):
+                num += 1
+        return num
+
+
+class ExitPolicyIndex(object):
+    """Exit eligibility of the relays of a consensus period as bitsets over
+    the positions of relays in cons_rel_stats. The bitset of relays whose
+    exit policy accepts a port is computed once for each range of ports
+    over which no policy changes, so further ports in the range are free."""
+
+    def __init__(self, cons_rel_stats, descriptors):
+        self.relays = list(cons_rel_stats)
+        self.flag_bits = [cons_rel_stats[relay].flag_bits
+                          for relay in self.relays]
+        # positions of relays with each exit policy
+        self.policies = {}
+        boundaries = set()
+        for i, relay in enumerate(self.relays):
+            desc = descriptors[relay]
+            if (desc.exit_policy not in self.policies):
+                self.policies[desc.exit_policy] = (desc, [])
+                for rule in desc.exit_policy:
+                    boundaries.add(rule.min_port)
+                    boundaries.add(rule.max_port + 1)
+            self.policies[desc.exit_policy][1].append(i)
+        self.boundaries = sorted(boundaries)
+        self.port_bits = {}
+        self.flag_masks = {}
+
+    def get_bitset(self, positions):
+        """Returns bitset with the given relay positions set."""
+        bits = bytearray('0' * len(self.relays))
+        for i in positions:
+            bits[-1 - i] = '1'
+        return int(str(bits), 2) if (len(bits) > 0) else 0
+
+    def get_port_bits(self, port, loose):
+        """Returns bitset of relays that exit to port (see exit_filter()),
+        or to some port if port is None."""
+        if (port == None):
+            key = None
+        else:
+            key = (bisect.bisect_right(self.boundaries, port), loose)
+        if (key not in self.port_bits):
+            positions = []
+            for desc, policy_positions in self.policies.itervalues():
+                if (port == None):
+                    accepts = not policy_is_reject_star(desc.exit_policy)
+                elif loose:
+                    accepts = might_exit_to_port(desc, port)
+                else:
+                    accepts = can_exit_to_port(desc, port)
+                if accepts:
+                    positions.extend(policy_positions)
+            self.port_bits[key] = self.get_bitset(positions)
+        return self.port_bits[key]
+
+    def get_flag_mask(self, fast, stable):
+        """Returns bitset of relays with the flags required of exits."""
+        if ((fast, stable) not in self.flag_masks):
+            required_bits = RUNNING_BIT | VALID_BIT
+            if fast:
+                required_bits |= FAST_BIT
+            if stable:
+                required_bits |= STABLE_BIT
+            self.flag_masks[(fast, stable)] = self.get_bitset(
+                i for i, flag_bits in enumerate(self.flag_bits)
+                if ((flag_bits & required_bits) == required_bits) and \
+                (not (flag_bits & BADEXIT_BIT)))
+        return self.flag_masks[(fast, stable)]
+
+    def get_exits(self, fast, stable, port, loose):
+        """Returns the relays filter_exits() (or filter_exits_loose() if
+        loose) gives for port, for non-internal circuits and unknown IP, in
+        the same order."""
+        bits = bin(self.get_port_bits(port, loose) & \
+                   self.get_flag_mask(fast, stable))[:1:-1]
+        exits = []
+        i = bits.find('1')
+        while (i >= 0):
+            exits.append(self.relays[i])
+            i = bits.find('1', i + 1)
+        return exits
+
+
+class ExitCache(object):
+    """Weighted exits (ConditionalSampler) of a consensus period keyed by
+    (fast, stable, port, loose), shared by port needs and streams. The exits
+    are kept for the next period if its exit candidates, i.e. relays and
+    their flags, exit weights, and exit policies, are unchanged."""
+
+    def __init__(self):
+        self.samplers = {}
+        self.candidates = None
+        self.cons_rel_stats = None
+        self.descriptors = None
+        self.exit_weights = None
+        self.hibernating_status = None
+        self.exit_index = None
+
+    def update(self, cons_rel_stats, descriptors, exit_weights,
+               hibernating_status):
+        """Sets network state of new consensus period, with exit weights
+        indexed by relay ID, and excludes relays hibernating according to
+        hibernating_status (a HibernatingStatus) from the exits. Returns if
+        the exits of the previous period were kept."""
+        candidates = dict((relay, (rel_stat.flag_bits, exit_weights[relay],
+                                   descriptors[relay].exit_policy))
+                          for relay, rel_stat in cons_rel_stats.iteritems())
+        kept = (candidates == self.candidates)
+        if (not kept):
+            self.samplers = {}
+            self.candidates = candidates
+        self.cons_rel_stats = cons_rel_stats
+        self.descriptors = descriptors
+        self.exit_weights = exit_weights
+        self.hibernating_status = hibernating_status
+        self.exit_index = None
+        for sampler in self.samplers.itervalues():
+            # families and addresses of kept exits may still have changed
+            sampler.descriptors = descriptors
+            sampler.subnets = None
+            hibernating_status.add_sampler(sampler)
+        return kept
+
+    def get_exits(self, fast, stable, port, loose):
+        """Returns ConditionalSampler of exits for port (see filter_exits()
+        and filter_exits_loose())."""
+        key = (fast, stable, port, loose)
+        if (key not in self.samplers):
+            if (self.exit_index is None):
+                self.exit_index = ExitPolicyIndex(self.cons_rel_stats,
+                                                  self.descriptors)
+            exits = self.exit_index.get_exits(fast, stable, port, loose)
+            if _testing:
+                print('# exits for fast={0}, stable={1}, port {2}, loose={3}: \
+{4}'.format(fast, stable, port, loose, len(exits)))
+            sampler = ConditionalSampler(exits, self.exit_weights,
+                                         self.cons_rel_stats, self.descriptors)
+            self.hibernating_status.add_sampler(sampler)
+            self.samplers[key] = sampler
+        return self.samplers[key]
+
+
+def disable_hibernating(sampler, hibernating_status):
+    """Disables relays hibernating according to hibernating_status in
+    ConditionalSampler, and enables any others it had disabled."""
+    for relay in [sampler.nodes[i] for i in sampler.disabled]:
+        if (not hibernating_status.get(relay, False)):
+            sampler.enable(relay)
+    for relay, hibernating in hibernating_status.iteritems():
+        if hibernating:
+            sampler.disable(relay)
+
+
+def intern_str(s):
+    """Returns interned s if it is a str, so that equal fingerprints and
+    nicknames share one object, and otherwise s."""
+    if (type(s) is str):
+        return intern(s)
+    return s
+
+
+def _get_slots_state(obj):
+    """Returns dict of slot values of obj for pickling."""
+    return dict((name, getattr(obj, name)) for name in obj.__slots__)
+
+
+def _set_slots_state(obj, state):
+    """Sets slots of obj from state dict, as pickled either by
+    _get_slots_state() or as the __dict__ of an older unslotted class."""
+    for name, value in state.iteritems():
+        setattr(obj, name, value)
+
+
+def get_subnet(address):
+    """Returns integer prefix of the subnet of the address string with
+    TorOptions.subnet_prefix_bits (or subnet_prefix_bits_ipv6) bits, where
+    IPv6 prefixes are offset to differ from IPv4 ones. Returns None if
+    address is None."""
+    if (address is None):
+        return None
+    if (':' in address):
+        high, low = struct.unpack('!QQ',
+            socket.inet_pton(socket.AF_INET6, address.strip('[]')))
+        return (1 << 32) + \
+            (((high << 64) | low) >> (128 - TorOptions.subnet_prefix_bits_ipv6))
+    return struct.unpack('!I', socket.inet_aton(address))[0] >> \
+        (32 - TorOptions.subnet_prefix_bits)
+
+
+def get_flag_bits(flags):
+    """Returns bitmask of FLAG_BITS for flags, ignoring unknown flags."""
+    flag_bits = 0
+    for flag in flags:
+        flag_bits |= FLAG_BITS.get(flag, 0)
+    return flag_bits
 
 
 def timestamp(t):
@@ -164,14 +987,63 @@ def timestamp(t):
     return ts
 
 
-def pad_network_state_files(network_state_files):
-    """Add hour-long gaps into files list where gaps exist in file times."""
+def find_network_state_files(nsf_dir, verify=False):
+    """Returns list of network state files in nsf_dir sorted by name, with
+    archives expanded into their entries, and dict of (valid_after,
+    fresh_until) by file for those files whose times are known without reading
+    them, i.e. from manifests and archive indexes. Directories whose manifest
+    doesn't match their files are listed without it. If verify, checks file
+    contents against manifest checksums."""
+    network_state_files = []
+    nsf_times = {}
+    for dirpath, dirnames, filenames in os.walk(nsf_dir, followlinks=True):
+        filenames = [filename for filename in filenames if (filename[0] != '.')]
+        manifest = nsf_format.read_manifest(dirpath)
+        if (manifest is not None):
+            if (set(manifest['files']) != set(filenames)):
+                sys.stderr.write('Ignoring manifest for {0}, which lists \
+different files.\n'.format(dirpath))
+                manifest = None
+            elif verify:
+                bad_files = nsf_format.verify_manifest(dirpath, manifest)
+                if bad_files:
+                    raise ValueError('Network state files don\'t match manifest \
+checksums: {0}'.format(', '.join(os.path.join(dirpath, filename) for filename in
+                                 bad_files)))
+        elif verify and filenames:
+            sys.stderr.write('No manifest to verify {0} with.\n'.format(dirpath))
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if filename.endswith(nsf_format.ARCHIVE_EXTENSION):
+                # expand archive into its NSFs
+                for entry in nsf_format.NetworkStateArchive(path).entries:
+                    network_state_files.append(entry)
+                    nsf_times[entry] = (entry.valid_after, entry.fresh_until)
+            else:
+                network_state_files.append(path)
+        if (manifest is not None):
+            for name, valid_after, fresh_until, _, _, filename in \
+                    manifest['network_states']:
+                if (name == filename):
+                    nsf_times[os.path.join(dirpath, name)] = \
+                        (valid_after, fresh_until)
+    network_state_files.sort(key=lambda x: os.path.basename(x))
+    return (network_state_files, nsf_times)
+
+
+def pad_network_state_files(network_state_files, nsf_times=None):
+    """Add hour-long gaps into files list where gaps exist in file times.
+    File times are taken from nsf_times (see find_network_state_files()) if
+    given there, and otherwise from the file names."""
     nsf_date = None
     network_state_files_padded = []
     for nsf in network_state_files:
-        f_datenums = map(int, os.path.basename(nsf).split('-')[:-1])
-        new_nsf_date = datetime.datetime(f_datenums[0], f_datenums[1], f_datenums[2], f_datenums[3], f_datenums[4],
-                                         f_datenums[5])
+        if (nsf_times is not None) and (nsf in nsf_times):
+            new_nsf_date = datetime.datetime.utcfromtimestamp(nsf_times[nsf][0])
+        else:
+            f_datenums = map(int, os.path.basename(nsf).split('-')[:-1])
+            new_nsf_date = datetime.datetime(f_datenums[0], f_datenums[1], f_datenums[2], f_datenums[3],
+                                             f_datenums[4], f_datenums[5])
         if (nsf_date != None):
             td = new_nsf_date - nsf_date
             if (int(td.total_seconds()) != 3600):
@@ -192,38 +1064,40 @@ def pad_network_state_files(network_state_files):
     return network_state_files_padded
 
 
-def get_bw_weight(flags, position, bw_weights):
+def get_bw_weight(flag_bits, position, bw_weights):
     """Returns weight to apply to relay's bandwidth for given position.
-        flags: list of Flag values for relay from a consensus
+        flag_bits: flag bitmask (see FLAG_BITS) for relay from a consensus
         position: position for which to find selection weight,
              one of 'g' for guard, 'm' for middle, and 'e' for exit
         bw_weights: bandwidth_weights from NetworkStatusDocumentV3 consensus
     """
 
+    is_guard = (flag_bits & GUARD_BIT)
+    is_exit = (flag_bits & EXIT_BIT)
     if (position == 'g'):
-        if (Flag.GUARD in flags) and (Flag.EXIT in flags):
+        if is_guard and is_exit:
             return bw_weights['Wgd']
-        elif (Flag.GUARD in flags):
+        elif is_guard:
             return bw_weights['Wgg']
-        elif (Flag.EXIT not in flags):
+        elif (not is_exit):
             return bw_weights['Wgm']
         else:
             raise ValueError('Wge weight does not exist.')
     elif (position == 'm'):
-        if (Flag.GUARD in flags) and (Flag.EXIT in flags):
+        if is_guard and is_exit:
             return bw_weights['Wmd']
-        elif (Flag.GUARD in flags):
+        elif is_guard:
             return bw_weights['Wmg']
-        elif (Flag.EXIT in flags):
+        elif is_exit:
             return bw_weights['Wme']
         else:
             return bw_weights['Wmm']
     elif (position == 'e'):
-        if (Flag.GUARD in flags) and (Flag.EXIT in flags):
+        if is_guard and is_exit:
             return bw_weights['Wed']
-        elif (Flag.GUARD in flags):
+        elif is_guard:
             return bw_weights['Weg']
-        elif (Flag.EXIT in flags):
+        elif is_exit:
             return bw_weights['Wee']
         else:
             return bw_weights['Wem']
@@ -232,26 +1106,10 @@ def get_bw_weight(flags, position, bw_weights):
             position))
 
 
-def select_weighted_node(weighted_nodes):
-    """Takes (node,cum_weight) pairs where non-negative cum_weight increases,
-    ending at 1. Use cum_weights as cumulative probablity to select a node."""
-    r = random()
-    begin = 0
-    end = len(weighted_nodes) - 1
-    mid = int((end + begin) / 2)
-    while True:
-        if (r <= weighted_nodes[mid][1]):
-            if (mid == begin):
-                return weighted_nodes[mid][0]
-            else:
-                end = mid
-                mid = int((end + begin) / 2)
-        else:
-            if (mid == end):
-                raise ValueError('Weights must sum to 1.')
-            else:
-                begin = mid + 1
-                mid = int((end + begin) / 2)
+def select_weighted_node(weighted_nodes, rng=rand):
+    """Takes WeightedSampler, as returned by get_weighted_nodes(), or
+    ConditionalSampler, and uses it to randomly select a node with rng."""
+    return weighted_nodes.select(rng=rng)
 
 
 def might_exit_to_port(descriptor, port):
@@ -307,13 +1165,13 @@ def exit_filter(exit, cons_rel_stats, descriptors, fast, stable, internal, ip, \
     loose than Tor and avoid false negatives (via loose=True).
     If IP and port not given, check policy for any allowed exiting. This
     behavior is for SOCKS RESOLVE requests in particular."""
-    rel_stat = cons_rel_stats[exit]
+    flag_bits = cons_rel_stats[exit].flag_bits
     desc = descriptors[exit]
-    if (Flag.BADEXIT not in rel_stat.flags) and \
-            (Flag.RUNNING in rel_stat.flags) and \
-            (Flag.VALID in rel_stat.flags) and \
-            ((not fast) or (Flag.FAST in rel_stat.flags)) and \
-            ((not stable) or (Flag.STABLE in rel_stat.flags)):
+    if (not (flag_bits & BADEXIT_BIT)) and \
+            (flag_bits & RUNNING_BIT) and \
+            (flag_bits & VALID_BIT) and \
+            ((not fast) or (flag_bits & FAST_BIT)) and \
+            ((not stable) or (flag_bits & STABLE_BIT)):
         if (internal):
             # In an "internal" circuit final node is chosen just like a
             # middle node (ignoring its exit policy).
@@ -357,36 +1215,75 @@ def get_position_weights(nodes, cons_rel_stats, position, bw_weights, \
     weights = {}
     for node in nodes:
         bw = float(cons_rel_stats[node].bandwidth)
-        weight = float(get_bw_weight(cons_rel_stats[node].flags, \
+        weight = float(get_bw_weight(cons_rel_stats[node].flag_bits, \
                                      position, bw_weights)) / float(bwweightscale)
         weights[node] = bw * weight
     return weights
 
 
+def get_all_position_weights(cons_rel_stats, bw_weights, bwweightscale,
+                             num_relays):
+    """Computes the consensus "bandwidth" weighted by position weights for all
+    relays at once, using NumPy if available. Returns dict with position keys
+    ('g', 'm', and 'e') and list values indexed by relay ID, with length
+    num_relays (greater than the largest ID) and weight zero for relays not in
+    cons_rel_stats. Relays with the Exit flag but not the Guard flag have no
+    guard weight (see get_bw_weight()) and are given zero guard weight."""
+    # weight factors indexed by (is_exit << 1) | is_guard
+    bwweightscale = float(bwweightscale)
+    factors = {}
+    for position, keys in (('g', ('Wgm', 'Wgg', None, 'Wgd')),
+                           ('m', ('Wmm', 'Wmg', 'Wme', 'Wmd')),
+                           ('e', ('Wem', 'Weg', 'Wee', 'Wed'))):
+        factors[position] = [0.0 if (key is None) else
+                             float(bw_weights[key]) / bwweightscale
+                             for key in keys]
+
+    if (numpy is None):
+        position_weights = {}
+        for position in factors:
+            position_weights[position] = [0.0] * num_relays
+        for relay, rel_stat in cons_rel_stats.iteritems():
+            bw = float(rel_stat.bandwidth)
+            category = (bool(rel_stat.flag_bits & EXIT_BIT) << 1) | \
+                bool(rel_stat.flag_bits & GUARD_BIT)
+            for position, weights in position_weights.iteritems():
+                weights[relay] = bw * factors[position][category]
+        return position_weights
+
+    num_cons_relays = len(cons_rel_stats)
+    relays = numpy.fromiter(cons_rel_stats.iterkeys(), numpy.int64,
+                            num_cons_relays)
+    bws = numpy.fromiter((rel_stat.bandwidth for rel_stat in
+                          cons_rel_stats.itervalues()), numpy.float64, num_cons_relays)
+    flag_bits = numpy.fromiter((rel_stat.flag_bits for rel_stat in
+                                cons_rel_stats.itervalues()), numpy.int64, num_cons_relays)
+    categories = (((flag_bits & EXIT_BIT) != 0) << 1) | \
+        ((flag_bits & GUARD_BIT) != 0)
+    position_weights = {}
+    for position in factors:
+        weights = numpy.zeros(num_relays)
+        weights[relays] = bws * numpy.array(factors[position])[categories]
+        position_weights[position] = weights.tolist()
+    return position_weights
+
+
 def get_weighted_nodes(nodes, weights):
     """Takes list of nodes (rel_stats) and weights (as a dict) and outputs
-    a list of (node, cum_weight) pairs, where cum_weight is the cumulative
-    probability of the nodes weighted by weights.
+    a WeightedSampler that selects nodes with probability proportional to
+    their weights.
     """
-    # compute total weight
-    total_weight = 0
-    for node in nodes:
-        total_weight += weights[node]
-    if (total_weight == 0):
-        raise ValueError('ERROR: Node list has total weight zero.')
-    # create cumulative weights
-    weighted_nodes = []
-    cum_weight = 0
-    for node in nodes:
-        cum_weight += weights[node] / total_weight
-        weighted_nodes.append((node, cum_weight))
-
-    return weighted_nodes
+    return WeightedSampler(nodes, weights)
 
 
 def in_same_family(descriptors, node1, node2):
     """Takes list of descriptors and two node fingerprints,
-    checks if nodes list each other as in the same family."""
+    checks if nodes list each other as in the same family.
+    Uses the family index of descriptors if it is a DescriptorStore."""
+
+    families = getattr(descriptors, 'families', None)
+    if (families is not None):
+        return (node1 in families) and (node2 in families[node1])
 
     desc1 = descriptors[node1]
     desc2 = descriptors[node2]
@@ -410,6 +1307,12 @@ def in_same_family(descriptors, node1, node2):
     return False
 
 
+def in_same_subnet(desc1, desc2):
+    """Takes two descriptors and checks if their addresses are in the same
+    subnet (by default /16, see TorOptions.subnet_prefix_bits)."""
+    return (desc1.subnet == desc2.subnet)
+
+
 def in_same_16_subnet(address1, address2):
     """Takes IPv4 addresses as strings and checks if the first two bytes
     are equal."""
@@ -437,27 +1340,32 @@ def middle_filter(node, cons_rel_stats, descriptors, fast=None, \
     unknown."""
     # Note that we intentionally allow non-Valid routers for middle
     # as per path-spec.txt default config    
-    rel_stat = cons_rel_stats[node]
-    return (Flag.RUNNING in rel_stat.flags) and \
+    flag_bits = cons_rel_stats[node].flag_bits
+    return (flag_bits & RUNNING_BIT) and \
         ((fast == None) or (not fast) or \
-         (Flag.FAST in rel_stat.flags)) and \
+         (flag_bits & FAST_BIT)) and \
         ((stable == None) or (not stable) or \
-         (Flag.STABLE in rel_stat.flags)) and \
+         (flag_bits & STABLE_BIT)) and \
         ((exit_node == None) or \
          ((exit_node != node) and \
           (not in_same_family(descriptors, exit_node, node)) and \
-          (not in_same_16_subnet(descriptors[exit_node].address, \
-                                 descriptors[node].address)))) and \
+          (not in_same_subnet(descriptors[exit_node], \
+                              descriptors[node])))) and \
         ((guard_node == None) or \
          ((guard_node != node) and \
           (not in_same_family(descriptors, guard_node, node)) and \
-          (not in_same_16_subnet(descriptors[guard_node].address, \
-                                 descriptors[node].address))))
+          (not in_same_subnet(descriptors[guard_node], \
+                              descriptors[node]))))
 
 
 def select_middle_node(bw_weights, bwweightscale, cons_rel_stats, descriptors, \
-                       fast, stable, exit_node, guard_node, weighted_middles=None):
-    """Chooses a valid middle node by selecting randomly until one is found."""
+                       fast, stable, exit_node, guard_node, weighted_middles=None,
+                       hibernating_status=None, rng=rand):
+    """Chooses a valid middle node (see middle_filter()) randomly from
+    weighted_middles, a ConditionalSampler, excluding invalid ones.
+    Hibernating relays must be disabled in weighted_middles (see
+    HibernatingStatus), and are excluded using hibernating_status if
+    weighted_middles is not given."""
 
     # create weighted middles if not given
     if (weighted_middles == None):
@@ -465,18 +1373,21 @@ def select_middle_node(bw_weights, bwweightscale, cons_rel_stats, descriptors, \
         # create cumulative weighted middles
         weights = get_position_weights(middles, cons_rel_stats, 'm', \
                                        bw_weights, bwweightscale)
-        weighted_middles = get_weighted_nodes(middles, weights)
-
-        # select randomly until acceptable middle node is found
-    i = 1
-    while True:
-        middle_node = select_weighted_node(weighted_middles)
-        if _testing:
-            print('select_middle_node() made choice #{0}.'.format(i))
-        i += 1
-        if (middle_filter(middle_node, cons_rel_stats, descriptors, fast, \
-                          stable, exit_node, guard_node)):
-            break
+        weighted_middles = ConditionalSampler(middles, weights, \
+                                              cons_rel_stats, descriptors)
+        if (hibernating_status is not None):
+            disable_hibernating(weighted_middles, hibernating_status)
+
+    # select from middles with needed flags that don't conflict with circuit
+    required_bits = RUNNING_BIT
+    if fast:
+        required_bits |= FAST_BIT
+    if stable:
+        required_bits |= STABLE_BIT
+    conflicting = [node for node in (exit_node, guard_node) if (node != None)]
+    middle_node = weighted_middles.select(conflicting, required_bits, rng)
+    if _testing:
+        print('select_middle_node() chose {0}.'.format(middle_node))
     return middle_node
 
 
@@ -515,15 +1426,15 @@ def guard_filter_for_circ(guard, cons_rel_stats, descriptors, fast, \
 
     if (guards[guard]['bad_since'] == None):
         if (guard in cons_rel_stats) and (guard in descriptors):
-            rel_stat = cons_rel_stats[guard]
-            return ((not fast) or (Flag.FAST in rel_stat.flags)) and \
-                ((not stable) or (Flag.STABLE in rel_stat.flags)) and \
+            flag_bits = cons_rel_stats[guard].flag_bits
+            return ((not fast) or (flag_bits & FAST_BIT)) and \
+                ((not stable) or (flag_bits & STABLE_BIT)) and \
                 ((guards[guard]['unreachable_since'] == None) or \
                  guard_is_time_to_retry(guards[guard], circ_time)) and \
                 (exit != guard) and \
                 (not in_same_family(descriptors, exit, guard)) and \
-                (not in_same_16_subnet(descriptors[exit].address, \
-                                       descriptors[guard].address))
+                (not in_same_subnet(descriptors[exit], \
+                                    descriptors[guard]))
         else:
             raise ValueError('Guard {0} not present in consensus or\ descriptors but wasn\'t marked bad.'.format(guard))
     else:
@@ -537,9 +1448,7 @@ def filter_guards(cons_rel_stats, descriptors):
     guards = []
     for fprint in cons_rel_stats:
         rel_stat = cons_rel_stats[fprint]
-        if (Flag.RUNNING in rel_stat.flags) and \
-                (Flag.VALID in rel_stat.flags) and \
-                (Flag.GUARD in rel_stat.flags) and \
+        if ((rel_stat.flag_bits & GUARD_FILTER_BITS) == GUARD_FILTER_BITS) and \
                 (fprint in descriptors):
             guards.append(fprint)
 
@@ -547,7 +1456,7 @@ def filter_guards(cons_rel_stats, descriptors):
 
 
 def get_new_guard(bw_weights, bwweightscale, cons_rel_stats, descriptors, \
-                  client_guards, weighted_guards=None):
+                  client_guards, weighted_guards=None, rng=rand):
     """Selects a new guard that doesn't conflict with the existing list."""
     # - doesn't conflict with current guards
     # - running
@@ -562,27 +1471,14 @@ def get_new_guard(bw_weights, bwweightscale, cons_rel_stats, descriptors, \
         guards = filter_guards(cons_rel_stats, descriptors)
         guard_weights = get_position_weights(guards, cons_rel_stats, \
                                              'g', bw_weights, bwweightscale)
-        weighted_guards = get_weighted_nodes(guards, guard_weights)
-
-        # Because conflict with current guards is unlikely,
-    # randomly select a guard, test, and repeat if necessary
-    i = 1
-    while True:
-        guard_node = select_weighted_node(weighted_guards)
-        if _testing:
-            print('get_new_guard() made choice #{0}.'.format(i))
-        i += 1
+        weighted_guards = ConditionalSampler(guards, guard_weights, \
+                                             cons_rel_stats, descriptors)
 
-        guard_conflict = False
-        for client_guard in client_guards:
-            if (client_guard == guard_node) or \
-                    (in_same_family(descriptors, client_guard, guard_node)) or \
-                    (in_same_16_subnet(descriptors[client_guard].address, \
-                                       descriptors[guard_node].address)):
-                guard_conflict = True
-                break
-        if (not guard_conflict):
-            break
+    # select from guards that are not the same as or in the same family or
+    # subnet as a current guard
+    guard_node = weighted_guards.select(client_guards, rng=rng)
+    if _testing:
+        print('get_new_guard() chose {0}.'.format(guard_node))
 
     return guard_node
 
@@ -590,7 +1486,7 @@ def get_new_guard(bw_weights, bwweightscale, cons_rel_stats, descriptors, \
 def get_guards_for_circ(bw_weights, bwweightscale, cons_rel_stats, \
                         descriptors, fast, stable, guards, \
                         exit, \
-                        circ_time, weighted_guards=None):
+                        circ_time, weighted_guards=None, rng=rand):
     """Obtains needed number of live guards that will work for circuit.
     Chooses new guards if needed, and *modifies* guard list by adding them."""
     # Get live guards then add new ones until TorOptions.num_guards_list reached,
@@ -603,7 +1499,6 @@ def get_guards_for_circ(bw_weights, bwweightscale, cons_rel_stats, \
     # after that point.
     # Note that hibernating status is not an input here.
     # Rules derived from Tor source: choose_random_entry_impl() in entrynodes.c
-    global GUARD_SAMPLED_INDEX
     # add guards if not enough in list
     if (len(guards) < TorOptions.num_guards_list):
         # Oddly then only count the number of live ones
@@ -612,51 +1507,44 @@ def get_guards_for_circ(bw_weights, bwweightscale, cons_rel_stats, \
         # Tor uses fixed Stable=False and Fast=True flags when calculating # 
         # live but fixed Stable=Fast=False when adding guards here (weirdly).
         # (as in choose_random_entry_impl() and its pick_entry_guards() call)
-        live_guards = filter(lambda x: (guards[x]['bad_since'] == None) and \
-                                       (x in descriptors) and \
-                                       ((guards[x]['unreachable_since'] == None) or \
-                                        guard_is_time_to_retry(guards[x], circ_time)), \
-                             guards)
-        for i in range(TorOptions.num_guards_list - len(live_guards)):
+        num_live_guards = guards.num_live(descriptors, circ_time)
+        for i in range(TorOptions.num_guards_list - num_live_guards):
             new_guard = get_new_guard(bw_weights, bwweightscale, \
                                       cons_rel_stats, descriptors, guards, \
-                                      weighted_guards)
+                                      weighted_guards, rng)
             if _testing:
                 print('Need guard. Adding {0} [{1}]'.format( \
                     cons_rel_stats[new_guard].nickname, new_guard))
-            expiration = randint(TorOptions.guard_expiration_min, \
+            expiration = rng.randint(TorOptions.guard_expiration_min, \
                                  TorOptions.guard_expiration_max)
             guards[new_guard] = {'expires': (expiration + \
                                              circ_time), 'bad_since': None, 'unreachable_since': None, \
-                                 'last_attempted': 0, 'made_contact': False, 'index': GUARD_SAMPLED_INDEX}
-            GUARD_SAMPLED_INDEX += 1
+                                 'last_attempted': 0, 'made_contact': False, 'index': guards.next_index}
 
-    # check for guards that will work for this circuit
+    # check for guards that will work for this circuit, in order of sampled
+    # index, until we have num_guards_choice of them; by default 1.
     guards_for_circ = []
-    # iterator over guards fingerprints, sorted by sampled index
-    guards_iterator = iter(
-        filter(lambda x: guard_filter_for_circ(x, cons_rel_stats, descriptors, fast, stable, exit, circ_time, guards),
-               sorted(guards, key=lambda x: guards[x]['index'])))
-    # We pick num_guards_choice of them; by default 1.
-    for _ in range(0, TorOptions.num_guards_choice):
-        guard = next(guards_iterator, None)
-        if guard is not None:
+    for guard in guards.order:
+        if (len(guards_for_circ) >= TorOptions.num_guards_choice):
+            break
+        if (guard not in guards.bad) and \
+                guard_filter_for_circ(guard, cons_rel_stats, descriptors,
+                                      fast, stable, exit, circ_time, guards):
             guards_for_circ.append(guard)
     # add new guards while there aren't enough for this circuit
     # adding is done without reference to the circuit - how Tor does it
     while len(guards_for_circ) < TorOptions.num_guards_choice:
         new_guard = get_new_guard(bw_weights, bwweightscale, \
                                   cons_rel_stats, descriptors, guards, \
-                                  weighted_guards)
+                                  weighted_guards, rng)
         if _testing:
             print('Need guard for circuit. Adding {0} [{1}]'.format( \
                 cons_rel_stats[new_guard].nickname, new_guard))
-        expiration = randint(TorOptions.guard_expiration_min, \
+        expiration = rng.randint(TorOptions.guard_expiration_min, \
                              TorOptions.guard_expiration_max)
         guards[new_guard] = {'expires': (expiration + \
                                          circ_time), 'bad_since': None, 'unreachable_since': None, \
-                             'last_attempted': 0, 'made_contact': False, 'index': GUARD_SAMPLED_INDEX}
-        GUARD_SAMPLED_INDEX += 1
+                             'last_attempted': 0, 'made_contact': False, 'index': guards.next_index}
         if (guard_filter_for_circ(new_guard, cons_rel_stats, descriptors, \
                                   fast, stable, exit, circ_time, guards)):
             guards_for_circ.append(new_guard)
@@ -754,16 +1642,20 @@ def kill_circuits_by_relay(client_state, relay_down_fn, msg):
     client_state['clean_exit_circuits'] = new_clean_exit_circuits
 
 
-def get_network_state(ns_file):
-    """Reads in network state file, returns NetworkState object."""
+def get_network_state(ns_file, nsf_reader=None):
+    """Reads in network state file, returns NetworkState object.
+    Delta network state files need the nsf_format.NetworkStateReader that read
+    the files before them."""
     if _testing:
         print('Using file {0}'.format(ns_file))
 
     cons_rel_stats = {}
-    with open(ns_file, 'r') as nsf:
-        consensus = pickle.load(nsf)
-        new_descriptors = pickle.load(nsf)
-        hibernating_statuses = pickle.load(nsf)
+    if (nsf_reader is None):
+        consensus, new_descriptors, hibernating_statuses = \
+            nsf_format.read_network_state_file(ns_file)
+    else:
+        consensus, new_descriptors, hibernating_statuses = \
+            nsf_reader.read(ns_file)
 
     # set variables from consensus
     cons_valid_after = timestamp(consensus.valid_after)
@@ -796,10 +1688,11 @@ def get_network_states(network_state_files, network_modifiers):
             None
     """
 
+    nsf_reader = nsf_format.NetworkStateReader()
     for ns_file in network_state_files:
         if (ns_file is not None):
             # get network state variables from file    
-            network_state = get_network_state(ns_file)
+            network_state = get_network_state(ns_file, nsf_reader)
             # apply network modifications
             for network_modifier in network_modifiers:
                 network_modifier.modify_network_state(network_state)
@@ -808,6 +1701,57 @@ def get_network_states(network_state_files, network_modifiers):
         yield network_state
 
 
+def prefetch_network_states(network_states, lookahead):
+    """Generator that yields the items of network_states in order, which are
+    produced (i.e. read and modified) by a background thread while the
+    caller uses earlier ones.
+    Input:
+        network_states: iterator yielding NetworkState objects or None, as
+            returned by get_network_states()
+        lookahead: (int) maximum number of items produced ahead of the caller,
+            bounding the memory used
+    Output:
+        network_states: iterator yielding the same items as the input
+    """
+    queue = Queue.Queue(lookahead)
+    stop = threading.Event()
+
+    def put(item):
+        """Blocks until item is queued or caller has stopped. Returns if the
+        item was queued."""
+        while (not stop.is_set()):
+            try:
+                queue.put(item, True, 0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for network_state in network_states:
+                if (not put((True, network_state))):
+                    return
+            put((False, None))
+        except Exception:
+            put((False, sys.exc_info()))
+
+    producer = threading.Thread(target=produce, name='nsf-prefetch')
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            # long timeout rather than none keeps the wait interruptible
+            is_network_state, value = queue.get(True, 365 * 24 * 3600)
+            if (not is_network_state):
+                if (value is not None):
+                    raise value[0], value[1], value[2]
+                break
+            yield value
+    finally:
+        stop.set()
+
+
 def set_initial_hibernating_status(hibernating_status, hibernating_statuses,
                                    cur_period_start, cons_rel_stats):
     """Reads hibernating statuses and updates initial relay status."""
@@ -818,7 +1762,7 @@ def set_initial_hibernating_status(hibernating_status, hibernating_statuses,
             print('Reset hibernating of {0}:{1} to {2}.'.format( \
                 cons_rel_stats[hs[1]].nickname, hibernating_status[hs[1]],
                 hs[2]))
-        hibernating_status[hs[1]] = hs[2]
+        hibernating_status.set_status(hs[1], hs[2])
         if _testing:
             if (hs[2]):
                 print('{0} was hibernating at start of consensus period.'. \
@@ -849,22 +1793,18 @@ def period_client_update(client_state, cons_rel_stats, cons_fresh_until, \
         # note that hibernating *not* considered here
         if (guard_props['bad_since'] == None):
             if (guard not in cons_rel_stats) or \
-                    (Flag.RUNNING not in \
-                     cons_rel_stats[guard].flags) or \
-                    (Flag.GUARD not in \
-                     cons_rel_stats[guard].flags):
+                    ((cons_rel_stats[guard].flag_bits & RUNNING_GUARD_BITS) != \
+                     RUNNING_GUARD_BITS):
                 if _testing:
                     print('Putting down guard {0}'.format(guard))
-                guard_props['bad_since'] = cons_valid_after
+                guards.set_bad_since(guard, cons_valid_after)
         else:
             if (guard in cons_rel_stats) and \
-                    (Flag.RUNNING in \
-                     cons_rel_stats[guard].flags) and \
-                    (Flag.GUARD in \
-                     cons_rel_stats[guard].flags):
+                    ((cons_rel_stats[guard].flag_bits & RUNNING_GUARD_BITS) == \
+                     RUNNING_GUARD_BITS):
                 if _testing:
                     print('Bringing up guard {0}'.format(guard))
-                guard_props['bad_since'] = None
+                guards.set_bad_since(guard, None)
         # remove if down time including this period exceeds limit
         if (guard_props['bad_since'] != None):
             if (cons_fresh_until - guard_props['bad_since'] >= \
@@ -884,7 +1824,7 @@ def period_client_update(client_state, cons_rel_stats, cons_fresh_until, \
     #  down is not in consensus or without Running flag.            
     kill_circuits_by_relay(client_state, \
                            lambda r: (r not in cons_rel_stats) or \
-                                     (Flag.RUNNING not in cons_rel_stats[r].flags), \
+                                     (not (cons_rel_stats[r].flag_bits & RUNNING_BIT)), \
                            'is down')
 
 
@@ -917,7 +1857,51 @@ def timed_updates(cur_time, port_needs_global, client_states,
                     print('{0}:{1} stopped hibernating.'. \
                           format(cons_rel_stats[hs[1]].nickname, hs[1]))
 
-        hibernating_status[hs[1]] = hs[2]
+        hibernating_status.set_status(hs[1], hs[2])
+
+
+def get_next_step_time(cur_time, time_step, period_start, streams,
+                       stream_idx, port_needs_global, client_states, hibernating_statuses):
+    """Returns the first time step after cur_time, counting steps of
+    time_step from period_start, at which timed updates or streams have an
+    effect, so that steps without any can be skipped. These are steps with
+    the next stream (from streams[stream_idx]), port need expiration,
+    hibernating status change, or dirty or clean circuit expiration, and the
+    next step if a client has uncovered port needs it can make circuits
+    for."""
+    next_step = cur_time + time_step
+    event_times = []
+    if (stream_idx < len(streams)):
+        # stream is assigned at the start of the step containing it
+        event_times.append(period_start + \
+                           int((streams[stream_idx]['time'] - period_start) // time_step) * \
+                           time_step)
+    for need in port_needs_global.itervalues():
+        if (need['expires'] != None):
+            event_times.append(need['expires'])
+    if hibernating_statuses:
+        event_times.append(hibernating_statuses[-1][0])
+    for client_state in client_states:
+        if (len(client_state['clean_exit_circuits']) < \
+                TorOptions.max_unused_open_circuits):
+            for port, need in port_needs_global.iteritems():
+                if (client_state['port_needs_covered'][port] < \
+                        need['cover_num']):
+                    return next_step
+        if (len(client_state['dirty_exit_circuits']) > 0):
+            event_times.append(
+                client_state['dirty_exit_circuits'][-1]['dirty_time'] + \
+                TorOptions.max_circuit_dirtiness)
+        if (len(client_state['clean_exit_circuits']) > 0):
+            event_times.append(
+                client_state['clean_exit_circuits'][-1]['time'] + \
+                TorOptions.circuit_idle_timeout)
+    if (not event_times):
+        return None
+    # first step at or after the earliest event
+    event_step = period_start + \
+                 int(-((period_start - min(event_times)) // time_step)) * time_step
+    return max(event_step, next_step)
 
 
 def timed_client_updates(cur_time, client_state, port_needs_global,
@@ -976,7 +1960,8 @@ def timed_client_updates(cur_time, client_state, port_needs_global,
                                           need['fast'], need['stable'], False, None, port,
                                           congmodel, pdelmodel,
                                           port_need_weighted_exits[port],
-                                          True, weighted_middles, weighted_guards, callbacks)
+                                          True, weighted_middles, weighted_guards, callbacks,
+                                          client_state['rng'])
                 client_state['clean_exit_circuits'].appendleft(new_circ)
 
                 # cover this port and any others
@@ -992,9 +1977,12 @@ def timed_client_updates(cur_time, client_state, port_needs_global,
 
 def stream_update_port_needs(stream, port_needs_global,
                              port_need_weighted_exits, client_states,
-                             descriptors, cons_rel_stats, cons_bw_weights, cons_bwweightscale):
+                             descriptors, cons_rel_stats, cons_bw_weights, cons_bwweightscale,
+                             exit_cache=None):
     """Updates port needs based on input stream.
-    If new port, returns updated list of exits filtered for port."""
+    If new port, returns updated list of exits filtered for port.
+    The exits of a new port are taken from exit_cache (an ExitCache) if
+    given."""
     if (stream['type'] == 'resolve'):
         # as in Tor, treat RESOLVE requests as port 80 for
         #  prediction (see rep_hist_note_used_resolve())
@@ -1025,6 +2013,11 @@ def stream_update_port_needs(stream, port_needs_global,
                         += 1
                     circuit['covering'].add(port)
         # precompute exit list and weights for new port need
+        if (exit_cache is not None):
+            port_need_weighted_exits[port] = exit_cache.get_exits( \
+                port_needs_global[port]['fast'], \
+                port_needs_global[port]['stable'], port, False)
+            return
         port_need_exits = filter_exits(cons_rel_stats, \
                                        descriptors, port_needs_global[port]['fast'], \
                                        port_needs_global[port]['stable'], False, \
@@ -1035,14 +2028,22 @@ def stream_update_port_needs(stream, port_needs_global,
         port_need_exit_weights = get_position_weights( \
             port_need_exits, cons_rel_stats, 'e', \
             cons_bw_weights, cons_bwweightscale)
-        pn_weighted_exits = \
-            get_weighted_nodes(port_need_exits, port_need_exit_weights)
+        pn_weighted_exits = ConditionalSampler(port_need_exits, \
+            port_need_exit_weights, cons_rel_stats, descriptors)
         port_need_weighted_exits[port] = pn_weighted_exits
 
 
 def get_stream_port_weighted_exits(stream_port, stream,
-                                   cons_rel_stats, descriptors, cons_bw_weights, cons_bwweightscale):
-    """Returns weighted exit list for port of stream."""
+                                   cons_rel_stats, descriptors, cons_bw_weights, cons_bwweightscale,
+                                   exit_cache=None):
+    """Returns weighted exit list for port of stream, taken from exit_cache
+    (an ExitCache) if given."""
+    if (exit_cache is not None):
+        if (stream['type'] == 'connect'):
+            return exit_cache.get_exits(True,
+                (stream_port in TorOptions.long_lived_ports), stream_port, True)
+        elif (stream['type'] == 'resolve'):
+            return exit_cache.get_exits(True, False, None, False)
     if (stream['type'] == 'connect'):
         stable = (stream_port in TorOptions.long_lived_ports)
         stream_exits = \
@@ -1066,8 +2067,8 @@ def get_stream_port_weighted_exits(stream_port, stream,
     stream_exit_weights = get_position_weights( \
         stream_exits, cons_rel_stats, 'e', \
         cons_bw_weights, cons_bwweightscale)
-    stream_weighted_exits = get_weighted_nodes( \
-        stream_exits, stream_exit_weights)
+    stream_weighted_exits = ConditionalSampler(stream_exits, \
+        stream_exit_weights, cons_rel_stats, descriptors)
     return stream_weighted_exits
 
 
@@ -1138,7 +2139,8 @@ at {0}'.format(stream['time']))
                                       descriptors, hibernating_status, guards, stream['time'], True,
                                       stable, False, stream['ip'], stream['port'],
                                       congmodel, pdelmodel, stream_weighted_exits, False,
-                                      weighted_middles, weighted_guards, callbacks)
+                                      weighted_middles, weighted_guards, callbacks,
+                                      client_state['rng'])
         elif (stream['type'] == 'resolve'):
             new_circ = create_circuit(cons_rel_stats,
                                       cons_valid_after, cons_fresh_until,
@@ -1146,7 +2148,8 @@ at {0}'.format(stream['time']))
                                       descriptors, hibernating_status, guards, stream['time'], True,
                                       False, False, None, None, congmodel, pdelmodel,
                                       stream_weighted_exits, True,
-                                      weighted_middles, weighted_guards, callbacks)
+                                      weighted_middles, weighted_guards, callbacks,
+                                      client_state['rng'])
         else:
             raise ValueError('Unrecognized stream in client_assign_stream(): \
 {0}'.format(stream['type']))
@@ -1172,13 +2175,16 @@ stream.'.format(stream['time']))
 
 
 def select_exit_node(bw_weights, bwweightscale, cons_rel_stats, descriptors, \
-                     fast, stable, internal, ip, port, weighted_exits=None, exits_exact=False):
+                     fast, stable, internal, ip, port, weighted_exits=None, exits_exact=False,
+                     hibernating_status=None, rng=rand):
     """Chooses a valid exit node. To improve performance when simulating many
     streams, we allow any input weighted_exits list to possibly include
     relays that are invalid for the current circuit (thus we can create
     weighted_exits less often by only considering the port instead of the
     ip/port). Then we randomly select from that list until a suitable exit is
-    found.
+    found. Hibernating relays must be disabled in weighted_exits (see
+    HibernatingStatus), and are excluded using hibernating_status if
+    weighted_exits is not given.
     """
     if (weighted_exits == None):
         # filter exit list
@@ -1192,16 +2198,19 @@ def select_exit_node(bw_weights, bwweightscale, cons_rel_stats, descriptors, \
         else:
             weights = get_position_weights(exits, cons_rel_stats, 'e', \
                                            bw_weights, bwweightscale)
-        weighted_exits = get_weighted_nodes(exits, weights)
+        weighted_exits = ConditionalSampler(exits, weights, cons_rel_stats, \
+                                            descriptors)
+        if (hibernating_status is not None):
+            disable_hibernating(weighted_exits, hibernating_status)
         exits_exact = True
 
     if (exits_exact):
-        return select_weighted_node(weighted_exits)
+        return select_weighted_node(weighted_exits, rng)
     else:
         # select randomly until acceptable exit node is found
         i = 1
         while True:
-            exit_node = select_weighted_node(weighted_exits)
+            exit_node = select_weighted_node(weighted_exits, rng)
             if _testing:
                 print('select_exit_node() made choice #{0}.'.format(i))
             i += 1
@@ -1224,18 +2233,19 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
                    guards, circ_time, circ_fast, circ_stable, circ_internal, circ_ip,
                    circ_port, congmodel, pdelmodel, weighted_exits=None,
                    exits_exact=False, weighted_middles=None, weighted_guards=None,
-                   callbacks=None):
+                   callbacks=None, rng=rand):
     """Creates path for requested circuit based on the input consensus
     statuses and descriptors.
     Inputs:
-        cons_rel_stats: (dict) relay fingerprint keys and relay status vals
+        cons_rel_stats: (dict) relay ID keys and relay status vals
         cons_valid_after: (int) timestamp of valid_after for consensus
         cons_fresh_until: (int) timestamp of fresh_until for consensus
         cons_bw_weights: (dict) bw_weights of consensus
         cons_bwweightscale: (should be float()able) bwweightscale of consensus
-        descriptors: (dict) relay fingerprint keys and descriptor vals
-        hibernating_status: (dict) indicates hibernating relays
-        guards: (dict) contains guards of requesting client
+        descriptors: (dict) relay ID keys and descriptor vals
+        hibernating_status: (HibernatingStatus) indicates hibernating relays,
+            which are disabled in weighted_exits and weighted_middles
+        guards: (GuardList) contains guards of requesting client
         circ_time: (int) timestamp of circuit request
         circ_fast: (bool) all relays should be fast
         circ_stable: (bool) all relays should be stable
@@ -1244,14 +2254,15 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
         circ_port: (int) desired TCP port (None if not known)
         congmodel: congestion model
         pdelmodel: propagation delay model
-        weighted_exits: (list) (middle, cum_weight) pairs for exit position
+        weighted_exits: (ConditionalSampler) for exit position
         exits_exact: (bool) Is weighted_exits exact or does it need rechecking?
             weighed_exits is special because exits are chosen first and thus
             don't depend on the other circuit positions, and so potentially are        
             precomputed exactly.
-        weighted_middles: (list) (middle, cum_weight) pairs for middle position
-        weighted_guards: (list) (middle, cum_weight) pairs for middle position
+        weighted_middles: (ConditionalSampler) for middle position
+        weighted_guards: (ConditionalSampler) for guard position
         callbacks: object w/ method circuit_creation(circuit)
+        rng: random number generator of requesting client
     Output:
         circuit: (dict) a newly created circuit with keys
             'time': (int) seconds from time zero
@@ -1259,7 +2270,7 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
             'stable': (bool) relays must have Stable flag
             'internal': (bool) is internal (e.g. for hidden service)
             'dirty_time': (int) timestamp of time dirtied, None if clean
-            'path': (tuple) list in-order fingerprints for path's nodes
+            'path': (tuple) list in-order relay IDs for path's nodes
             'covering': (set) ports with needs covered by circuit        
     """
 
@@ -1271,19 +2282,11 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
     ntor_supported = False
     while (num_attempts < TorOptions.max_populate_attempts) and \
             (not ntor_supported):
-        # select exit node
-        i = 1
-        while (True):
-            exit_node = select_exit_node(cons_bw_weights, cons_bwweightscale, \
-                                         cons_rel_stats, descriptors, circ_fast, circ_stable, \
-                                         circ_internal, circ_ip, circ_port, weighted_exits, exits_exact)
-            #        exit_node = select_weighted_node(weighted_exits)
-            if (not hibernating_status[exit_node]):
-                break
-            if _testing:
-                print('Exit selection #{0} is hibernating - retrying.'. \
-                      format(i))
-            i += 1
+        # select exit node, which is never hibernating
+        exit_node = select_exit_node(cons_bw_weights, cons_bwweightscale, \
+                                     cons_rel_stats, descriptors, circ_fast, circ_stable, \
+                                     circ_internal, circ_ip, circ_port, weighted_exits, exits_exact,
+                                     hibernating_status, rng)
         if _testing:
             print('Exit node: {0} [{1}]'.format(
                 cons_rel_stats[exit_node].nickname,
@@ -1300,8 +2303,8 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
                                               cons_bwweightscale, cons_rel_stats, descriptors, \
                                               circ_fast, circ_stable, guards, \
                                               exit_node, \
-                                              circ_time, weighted_guards)
-            guard_node = rand.choice(circ_guards)
+                                              circ_time, weighted_guards, rng)
+            guard_node = rng.choice(circ_guards)
             if (hibernating_status[guard_node]):
                 if (not guards[guard_node]['made_contact']):
                     del guards[guard_node]
@@ -1332,20 +2335,13 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
                 cons_rel_stats[guard_node].fingerprint))
 
         # select middle node
-        # As with exit selection, hibernating status checked here to mirror Tor
+        # As with exit selection, hibernating relays are excluded to mirror Tor
         # selecting middle, having the circuit fail, reselecting a path,
-        # and attempting circuit creation again.    
-        i = 1
-        while (True):
-            middle_node = select_middle_node(cons_bw_weights,
-                                             cons_bwweightscale, cons_rel_stats, descriptors, circ_fast,
-                                             circ_stable, exit_node, guard_node, weighted_middles)
-            if (not hibernating_status[middle_node]):
-                break
-            if _testing:
-                print('Middle selection #{0} is hibernating - retrying.'. \
-                      format(i))
-            i += 1
+        # and attempting circuit creation again.
+        middle_node = select_middle_node(cons_bw_weights,
+                                         cons_bwweightscale, cons_rel_stats, descriptors, circ_fast,
+                                         circ_stable, exit_node, guard_node, weighted_middles,
+                                         hibernating_status, rng)
         if _testing:
             print('Middle node: {0} [{1}]'.format(
                 cons_rel_stats[middle_node].nickname,
@@ -1378,8 +2374,62 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
     return circuit
 
 
+def get_sample_rng(random_seed, sample_id):
+    """Returns random number generator for sample seeded from random_seed and
+    sample_id, so that the draws of a sample don't depend on other samples,
+    or seeded randomly if random_seed is None."""
+    if (random_seed == None):
+        return rand.Random()
+    seed = hashlib.sha1('{0}:{1}'.format(random_seed, sample_id)).hexdigest()
+    return rand.Random(int(seed, 16))
+
+
+def write_checkpoint(filename, state):
+    """Writes simulation state to filename as a compressed pickle, replacing
+    any previous checkpoint only once the new one is complete."""
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        gzip_file = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=1)
+        pickle.dump(state, gzip_file, pickle.HIGHEST_PROTOCOL)
+        gzip_file.close()
+    os.rename(tmp_filename, filename)
+
+
+def read_checkpoint(filename):
+    """Returns simulation state written by write_checkpoint()."""
+    with open(filename, 'rb') as f:
+        gzip_file = gzip.GzipFile(fileobj=f, mode='rb')
+        state = pickle.load(gzip_file)
+        gzip_file.close()
+    return state
+
+
+def wait_for_checkpoint_writer(writer):
+    """Waits for process started by start_checkpoint_writer() to finish."""
+    writer.join()
+    if (writer.exitcode != 0):
+        raise RuntimeError('Checkpoint writer exited with code {0}'.\
+            format(writer.exitcode))
+
+
+def start_checkpoint_writer(filename, state, prev_writer=None):
+    """Writes checkpoint in forked process, which gets a copy-on-write
+    snapshot of state, so that the simulation continues meanwhile. Waits for
+    prev_writer first, so checkpoints are written in order.
+    Returns the writer process."""
+    if (prev_writer is not None):
+        wait_for_checkpoint_writer(prev_writer)
+    # avoid writer writing out what is buffered
+    sys.stdout.flush()
+    writer = multiprocessing.Process(target=write_checkpoint,
+                                     args=(filename, state))
+    writer.start()
+    return writer
+
+
 def create_circuits(network_states, streams, num_samples, congmodel,
-                    pdelmodel, callbacks=None):
+                    pdelmodel, callbacks=None, first_sample_id=0, random_seed=None,
+                    checkpoint_file=None, checkpoint_interval=0, resume=False):
     """Takes streams over time and creates circuits by interaction
     with create_circuit().
       Input:
@@ -1396,8 +2446,19 @@ def create_circuits(network_states, streams, num_samples, congmodel,
         congmodel: (CongestionModel) outputs congestion used by some path algs
         pdelmodel: (PropagationDelayModel) outputs prop delay
         callbacks: obj providing callback interface, cf. event_callbacks module
+        first_sample_id: (int) ID of first sample, with the others numbered
+            consecutively
+        random_seed: seed of the random number generators of samples (see
+            get_sample_rng())
+        checkpoint_file: file to write simulation state to
+        checkpoint_interval: (int) minimum number of consensus periods
+            between checkpoints, with 0 writing none
+        resume: continue from state in checkpoint_file, skipping the network
+            states and streams it covers
     Output:
         Uses callbacks to produce any desired output.
+    Relays are keyed by fingerprint in network_states and in what is given to
+    callbacks, and by RelayIdTable ID in between.
     """
 
     ### Simulation variables ###
@@ -1407,29 +2468,91 @@ def create_circuits(network_states, streams, num_samples, congmodel,
     stream_end = 0
     init = True
 
+    # relays are keyed by integer ID except when given to callbacks
+    relay_ids = RelayIdTable()
+
+    # weighted exits shared by port needs and streams
+    exit_cache = ExitCache()
+
     # store old descriptors (for entry guards that leave consensus)
     # initialize with add_descriptors 
-    descriptors = {}
+    descriptors = DescriptorStore(TorOptions.router_max_age)
 
     port_needs_global = {}
 
     # client states for each sample
     client_states = []
-    for i in range(num_samples):
-        # guard is dict with client guard state (expiration, bad_since, etc.)
+    for i in range(first_sample_id, first_sample_id + num_samples):
+        # guards is GuardList with client guard state (expiration, bad_since,
+        #  etc.)
         # port_needs are ports that must be covered by existing circuits        
         # circuit vars are ordered by increasing time since create or dirty
+        # rng is the sample's own random number generator
         port_needs_covered = {}
         client_states.append({'id': i,
-                              'guards': {},
+                              'rng': get_sample_rng(random_seed, i),
+                              'guards': GuardList(),
                               'port_needs_covered': port_needs_covered,
                               'clean_exit_circuits': collections.deque(),
                               'dirty_exit_circuits': collections.deque()})
+
+    # number of network states consumed
+    num_periods = 0
     ### End simulation variables ###
 
+    if resume:
+        state = read_checkpoint(checkpoint_file)
+        sample_ids = [client_state['id'] for client_state in client_states]
+        if (state['sample_ids'] != sample_ids) or \
+                (state['random_seed'] != random_seed):
+            raise ValueError('Checkpoint {0} is not of samples {1} to {2} with \
+random seed {3}'.format(checkpoint_file, sample_ids[0], sample_ids[-1],
+                        random_seed))
+        num_periods = state['num_periods']
+        cur_period_start = state['cur_period_start']
+        cur_period_end = state['cur_period_end']
+        stream_start = state['stream_start']
+        init = state['init']
+        relay_ids = state['relay_ids']
+        exit_cache = state['exit_cache']
+        descriptors = state['descriptors']
+        port_needs_global = state['port_needs_global']
+        client_states = state['client_states']
+        del state
+        network_states = itertools.islice(network_states, num_periods, None)
+    checkpoint_period = num_periods
+    checkpoint_writer = None
+
+    if (callbacks is not None):
+        callbacks = FingerprintCallbacks(callbacks, relay_ids)
+
     # run simulation period one network state at a time
     for network_state in network_states:
+        # checkpoint only before new network states, which a gap would need
+        if (checkpoint_file is not None) and (checkpoint_interval > 0) and \
+                (network_state != None) and \
+                (num_periods - checkpoint_period >= checkpoint_interval):
+            checkpoint_writer = start_checkpoint_writer(checkpoint_file,
+                {'sample_ids': [client_state['id'] for client_state in \
+                    client_states],
+                 'random_seed': random_seed,
+                 'num_periods': num_periods,
+                 'cur_period_start': cur_period_start,
+                 'cur_period_end': cur_period_end,
+                 'stream_start': stream_start,
+                 'init': init,
+                 'relay_ids': relay_ids,
+                 'exit_cache': exit_cache,
+                 'descriptors': descriptors,
+                 'port_needs_global': port_needs_global,
+                 'client_states': client_states}, checkpoint_writer)
+            checkpoint_period = num_periods
+            if _testing:
+                print('Writing checkpoint after {0} network states at {1}'.\
+                    format(num_periods, cur_period_end))
+        num_periods += 1
         if (network_state != None):
+            network_state = relay_ids.convert_network_state(network_state)
             cons_valid_after = network_state.cons_valid_after
             cons_fresh_until = network_state.cons_fresh_until
             cons_bw_weights = network_state.cons_bw_weights
@@ -1439,10 +2562,7 @@ def create_circuits(network_states, streams, num_samples, congmodel,
             new_descriptors = network_state.descriptors
 
             # clear hibernating status to ensure updates come from ns_file
-            hibernating_status = {}
-
-            # update descriptors
-            descriptors.update(new_descriptors)
+            hibernating_status = HibernatingStatus()
 
         else:
             # gap in consensuses, just advance an hour, keeping network state            
@@ -1454,6 +2574,9 @@ def create_circuits(network_states, streams, num_samples, congmodel,
                 print('Filling in consensus gap from {0} to {1}'. \
                       format(cons_valid_after, cons_fresh_until))
 
+        # update descriptors, with relays of a repeated state still seen
+        descriptors.add_seen(new_descriptors, cons_valid_after)
+
         # update network state of callbacks object
         if (callbacks is not None):
             callbacks.set_network_state(cons_valid_after, cons_fresh_until,
@@ -1491,20 +2614,33 @@ def create_circuits(network_states, streams, num_samples, congmodel,
             period_client_update(client_state, cons_rel_stats, \
                                  cons_fresh_until, cons_valid_after)
 
+        # forget descriptors of long-gone relays that aren't client guards
+        num_evicted = descriptors.evict(cons_valid_after,
+            lambda: set(guard for client_state in client_states
+                        for guard in client_state['guards']))
+        if _testing:
+            print('Evicted {0} descriptors, storing {1} (max {2}, {3} evicted \
+in total).'.format(num_evicted, len(descriptors), descriptors.max_size,
+                   descriptors.num_evicted))
+
+        # compute position weights of all relays in one pass
+        position_weights = get_all_position_weights(cons_rel_stats,
+            cons_bw_weights, cons_bwweightscale, len(relay_ids.fingerprints))
+
+        # samplers of this period exclude hibernating relays
+        hibernating_status.remove_samplers()
+
         # filter exits for port needs and compute their weights
         # do this here to avoid repeating per client
+        # keep exits of previous period if its candidates are unchanged
+        kept_exits = exit_cache.update(cons_rel_stats, descriptors,
+            position_weights['e'], hibernating_status)
+        if _testing:
+            print('Kept exits of previous period: {0}'.format(kept_exits))
         port_need_weighted_exits = {}
         for port, need in port_needs_global.items():
-            port_need_exits = filter_exits(cons_rel_stats, descriptors, \
-                                           need['fast'], need['stable'], False, None, port)
-            if _testing:
-                print('# exits for port {0}: {1}'. \
-                      format(port, len(port_need_exits)))
-            port_need_exit_weights = get_position_weights( \
-                port_need_exits, cons_rel_stats, 'e', cons_bw_weights, \
-                cons_bwweightscale)
-            port_need_weighted_exits[port] = \
-                get_weighted_nodes(port_need_exits, port_need_exit_weights)
+            port_need_weighted_exits[port] = exit_cache.get_exits( \
+                need['fast'], need['stable'], port, False)
 
         # Store filtered exits for streams based only on port.
         # Conservative - never excludes a relay that exits to port for some ip.
@@ -1516,10 +2652,9 @@ def create_circuits(network_states, streams, num_samples, congmodel,
                                                            descriptors, None, None, None, None), cons_rel_stats.keys())
         if _testing:
             print('# potential middles: {0}'.format(len(potential_middles)))
-        potential_middle_weights = get_position_weights(potential_middles, \
-                                                        cons_rel_stats, 'm', cons_bw_weights, cons_bwweightscale)
-        weighted_middles = get_weighted_nodes(potential_middles, \
-                                              potential_middle_weights)
+        weighted_middles = ConditionalSampler(potential_middles, \
+            position_weights['m'], cons_rel_stats, descriptors)
+        hibernating_status.add_sampler(weighted_middles)
 
         # filter guards and precompute cumulative weights
         # New guards are selected infrequently after the experiment start
@@ -1528,15 +2663,14 @@ def create_circuits(network_states, streams, num_samples, congmodel,
         potential_guards = filter_guards(cons_rel_stats, descriptors)
         if _testing:
             print('# potential guards: {0}'.format(len(potential_guards)))
-        potential_guard_weights = get_position_weights(potential_guards, \
-                                                       cons_rel_stats, 'g', cons_bw_weights, cons_bwweightscale)
-        weighted_guards = get_weighted_nodes(potential_guards, \
-                                             potential_guard_weights)
+        weighted_guards = ConditionalSampler(potential_guards, \
+            position_weights['g'], cons_rel_stats, descriptors)
 
-        # for simplicity, step through time one minute at a time
+        # step through time one minute at a time, skipping minutes in which
+        # nothing happens
         time_step = 60
         cur_time = cur_period_start
-        while (cur_time < cur_period_end):
+        while (cur_time != None) and (cur_time < cur_period_end):
             # do updates that apply to all clients    
             timed_updates(cur_time, port_needs_global, client_states,
                           hibernating_statuses, hibernating_status, cons_rel_stats)
@@ -1568,7 +2702,8 @@ def create_circuits(network_states, streams, num_samples, congmodel,
                 # add need/extend expiration for ports in streams
                 stream_update_port_needs(stream, port_needs_global,
                                          port_need_weighted_exits, client_states, descriptors,
-                                         cons_rel_stats, cons_bw_weights, cons_bwweightscale)
+                                         cons_rel_stats, cons_bw_weights, cons_bwweightscale,
+                                         exit_cache)
 
                 # stream port for purposes of using precomputed exit lists
                 if (stream['type'] == 'resolve'):
@@ -1580,7 +2715,8 @@ def create_circuits(network_states, streams, num_samples, congmodel,
                     stream_port_weighted_exits[stream_port] = \
                         get_stream_port_weighted_exits(stream_port, stream,
                                                        cons_rel_stats, descriptors,
-                                                       cons_bw_weights, cons_bwweightscale)
+                                                       cons_bw_weights, cons_bwweightscale,
+                                                       exit_cache)
 
                 # do client stream assignment
                 for client_state in client_states:
@@ -1600,7 +2736,141 @@ def create_circuits(network_states, streams, num_samples, congmodel,
                         weighted_middles, weighted_guards,
                         congmodel, pdelmodel, callbacks)
 
-            cur_time += time_step
+            cur_time = get_next_step_time(cur_time, time_step,
+                                          cur_period_start, streams, stream_end, port_needs_global,
+                                          client_states, hibernating_statuses)
+
+    if (checkpoint_writer is not None):
+        wait_for_checkpoint_writer(checkpoint_writer)
+
+
+def get_segments(network_states, num_segments, warmup_periods=0):
+    """Splits list of network states into consecutive segments of about
+    equal numbers of periods, each preceded by a warm-up of at least
+    warmup_periods periods (fewer at the start of network_states).
+    Segments and warm-ups start with a network state rather than a gap
+    (i.e. None), as a gap repeats the previous one.
+    Returns list of (warmup_start, start, end) indices into network_states,
+    with the segment being network_states[start:end]."""
+    starts = []
+    for i in xrange(num_segments):
+        start = i * len(network_states) // num_segments
+        while (start < len(network_states)) and \
+                (network_states[start] == None):
+            start += 1
+        if (start < len(network_states)) and \
+                ((len(starts) == 0) or (start > starts[-1])):
+            starts.append(start)
+    segments = []
+    for i, start in enumerate(starts):
+        if (i + 1 < len(starts)):
+            end = starts[i + 1]
+        else:
+            end = len(network_states)
+        warmup_start = max(0, start - warmup_periods)
+        while (warmup_start > 0) and (network_states[warmup_start] == None):
+            warmup_start -= 1
+        segments.append((warmup_start, start, end))
+    return segments
+
+
+def create_circuits_in_workers(network_states, streams, num_samples,
+                               congmodel, pdelmodel, num_workers, get_callbacks=None,
+                               first_sample_id=0, random_seed=None, checkpoint_file=None,
+                               checkpoint_interval=0, resume=False, num_segments=1,
+                               warmup_periods=0):
+    """Splits samples into consecutive ranges and runs create_circuits() for
+    each range in a forked worker process. Can also split the network states
+    into time segments (see get_segments()), simulated by separate workers,
+    with each segment's clients starting in its warm-up, whose output is
+    discarded.
+      Input:
+        network_states, streams, num_samples, congmodel, pdelmodel: as for
+            create_circuits()
+        num_workers: (int) number of worker processes per segment
+        get_callbacks: function taking a file and returning the callbacks
+            object of a worker, which should write its output to that file
+        first_sample_id, random_seed: as for create_circuits(), with the
+            random generators of samples in later segments seeded from
+            random_seed and the segment start
+        checkpoint_file: prefix of the checkpoint files of workers, which
+            are named by it, their segment (if several) and first sample ID
+        checkpoint_interval, resume: as for create_circuits()
+        num_segments: (int) number of time segments
+        warmup_periods: (int) minimum number of consensus periods simulated
+            before each segment
+      Output:
+        Writes the output of the workers to sys.stdout in time segment and
+        then sample order.
+    Network states are read and modified once, before forking, and are
+    shared by the workers copy-on-write."""
+    network_states = list(network_states)
+    num_workers = max(1, min(num_workers, num_samples))
+    segments = get_segments(network_states, num_segments, warmup_periods)
+    out_dir = tempfile.mkdtemp(prefix='pathsim-')
+
+    def simulate_samples(segment_id, first_sample_id, num_worker_samples,
+                         out_filename):
+        # testing output also goes with the worker's samples, and the file
+        # is left open for multiprocessing to flush stdout on exit
+        out_file = open(out_filename, 'w')
+        sys.stdout = out_file
+        warmup_start, start, end = segments[segment_id]
+        callbacks = None
+        if (get_callbacks is not None):
+            callbacks = get_callbacks(out_file)
+            if (warmup_start < start):
+                callbacks = WarmupCallbacks(callbacks,
+                                            network_states[start].cons_valid_after)
+        segment_random_seed = random_seed
+        if (start > 0) and (random_seed is not None):
+            segment_random_seed = '{0}@{1}'.format(random_seed,
+                network_states[start].cons_valid_after)
+        worker_checkpoint_file = None
+        if (checkpoint_file is not None) and (len(segments) > 1):
+            worker_checkpoint_file = '{0}-{1}-{2}'.format(checkpoint_file,
+                                                          segment_id, first_sample_id)
+        elif (checkpoint_file is not None):
+            worker_checkpoint_file = '{0}-{1}'.format(checkpoint_file,
+                                                      first_sample_id)
+        create_circuits(network_states[warmup_start:end], streams,
+                        num_worker_samples, congmodel, pdelmodel, callbacks,
+                        first_sample_id, segment_random_seed,
+                        worker_checkpoint_file, checkpoint_interval, resume)
+        out_file.flush()
+
+    workers = []
+    try:
+        # avoid workers writing out what is buffered
+        sys.stdout.flush()
+        for segment_id in xrange(len(segments)):
+            worker_sample_id = first_sample_id
+            for i in xrange(num_workers):
+                num_worker_samples = num_samples // num_workers
+                if (i < num_samples % num_workers):
+                    num_worker_samples += 1
+                out_filename = os.path.join(out_dir,
+                    'samples-{0}-{1}'.format(segment_id, worker_sample_id))
+                worker = multiprocessing.Process(target=simulate_samples,
+                    args=(segment_id, worker_sample_id, num_worker_samples,
+                          out_filename))
+                worker.start()
+                workers.append((worker, segment_id, worker_sample_id,
+                                out_filename))
+                worker_sample_id += num_worker_samples
+        for worker, segment_id, worker_sample_id, out_filename in workers:
+            worker.join()
+            if (worker.exitcode != 0):
+                raise RuntimeError('Worker for segment {0} samples from {1} \
+exited with code {2}'.format(segment_id, worker_sample_id, worker.exitcode))
+            with open(out_filename) as out_file:
+                shutil.copyfileobj(out_file, sys.stdout)
+        sys.stdout.flush()
+    finally:
+        for worker, _, _, _ in workers:
+            if worker.is_alive():
+                worker.terminate()
+        shutil.rmtree(out_dir)
 
 
 def get_user_model(start_time, end_time, tracefilename=None,
@@ -1638,7 +2908,10 @@ def get_user_model(start_time, end_time, tracefilename=None,
     return streams
 
 
-if __name__ == '__main__':
+def main():
+    """Runs the command given by the command-line arguments."""
+    # the simulate command sets testing output and the path algorithm
+    global _testing, create_circuits, create_circuit, client_assign_stream
     import argparse
 
     # parse arguments    
@@ -1670,6 +2943,13 @@ directories are located')
                                 help='Output the "fat" representation instead of TorPS classes, which TorPS cannot use for simulation')
     process_parser.add_argument('--initial_descriptor_dir', default=None,
                                 help='Directory containing descriptors to initialize consensus processing. Needed to provide first consensuses in a month with descriptors only contained in archive from previous month. If omitted, first 24 hours of network state files will likely omit relays due to missing descriptors.')
+    process_parser.add_argument('--nsf_format', choices=['columnar', 'pickle'],
+                                default='columnar',
+                                help='Format of output network state files: "columnar" files are memory-mapped by the simulator, "pickle" files are the format of older TorPS versions. Both can be simulated.')
+    process_parser.add_argument('--keyframe_interval', type=int, default=0,
+                                help='If greater than 1, write each month of columnar network state files as chains of this many files: a complete keyframe followed by files containing only the changes since the previous file. A value of 24 typically reduces disk use several times over.')
+    process_parser.add_argument('--archive', action='store_true',
+                                help='Write each month of columnar network state files into a single archive file in the month\'s output directory instead of a file per consensus')
 
     simulate_parser = subparsers.add_parser('simulate',
                                             help='Do simulated path selections.')
@@ -1716,7 +2996,25 @@ may expire, with 0 indicating no guard expiration')
                                  help='set level of log messages to send to stdout, DEBUG produces testing output, quiet at all other levels',
                                  default='INFO')
     simulate_parser.add_argument('--random_seed', type=int, default=None,
-                                 help="Seed to use for the random number generator")
+                                 help="Seed to use for the random number generator, from which each sample seeds its own")
+    simulate_parser.add_argument('--first_sample', type=int, default=0,
+                                 help='ID of the first sample, so that samples from it can be rerun with the results they have in a run of all samples')
+    simulate_parser.add_argument('--verify_manifest', action='store_true',
+                                 help='check network state files against the checksums in the manifests written by the process command before simulating')
+    simulate_parser.add_argument('--prefetch', type=int, default=0,
+                                 help='number of network states to read and modify ahead of the simulation in a background thread, with 0 reading each when needed')
+    simulate_parser.add_argument('--workers', type=int, default=1,
+                                 help='number of forked processes to split samples across, which share network states read and modified once (held in memory for the whole period) and write output in sample order')
+    simulate_parser.add_argument('--segments', type=int, default=1,
+                                 help='number of time segments to split the network states into, simulated in parallel by forked processes (as for --workers) with clients starting in a warm-up before each segment')
+    simulate_parser.add_argument('--warmup_periods', type=int, default=720,
+                                 help='minimum number of consensus periods simulated without output before each time segment, for client guard state to reach steady state')
+    simulate_parser.add_argument('--checkpoint', default=None,
+                                 help='file to write simulation state to, with each worker adding its first sample ID to the name')
+    simulate_parser.add_argument('--checkpoint_interval', type=int, default=24,
+                                 help='minimum number of consensus periods between checkpoints')
+    simulate_parser.add_argument('--resume', action='store_true',
+                                 help='continue simulation from the state in the --checkpoint file, with the same other arguments')
 
     pathalg_subparsers = simulate_parser.add_subparsers(help='simulate\
 commands', dest='pathalg_subparser')
@@ -1759,6 +3057,8 @@ pathsim, and pickle it. The pickled object is input to the simulate command')
     args = parser.parse_args()
 
     if args.subparser == 'process':
+        if args.archive and (args.fat or (args.nsf_format != 'columnar')):
+            raise ValueError('--archive requires columnar network state files.')
         in_dirs = []
         month = args.start_month
         for year in range(args.start_year, args.end_year + 1):
@@ -1779,7 +3079,8 @@ pathsim, and pickle it. The pickled object is input to the simulate command')
                 month += 1
 
             month = 1
-        process_consensuses.process_consensuses(in_dirs, args.fat, args.initial_descriptor_dir)
+        process_consensuses.process_consensuses(in_dirs, args.fat, args.initial_descriptor_dir,
+                                                args.nsf_format, args.keyframe_interval, args.archive)
     elif (args.subparser == 'simulate'):
         logging.basicConfig(stream=sys.stdout, level=getattr(logging,
                                                              args.loglevel))
@@ -1804,21 +3105,17 @@ pathsim, and pickle it. The pickled object is input to the simulate command')
 
         ## create iterator producing sequence of simulation network states ##
         # obtain list of network state files contained in nsf_dir
-        network_state_files = []
-        for dirpath, dirnames, filenames in os.walk(args.nsf_dir,
-                                                    followlinks=True):
-            for filename in filenames:
-                if (filename[0] != '.'):
-                    network_state_files.append(os.path.join(dirpath, filename))
+        network_state_files, nsf_times = find_network_state_files(
+            args.nsf_dir, args.verify_manifest)
         # insert gaps for missing time periods
-        network_state_files.sort(key=lambda x: os.path.basename(x))
-        network_state_files = pad_network_state_files(network_state_files)
+        network_state_files = pad_network_state_files(network_state_files,
+                                                      nsf_times)
         # create object that will add adversarial relays into network
         adv_insertion = network_modifiers.AdversaryInsertion(args.adv_time,
                                                              args.num_adv_guards, args.adv_guard_cons_bw,
                                                              args.num_adv_exits,
                                                              args.adv_exit_cons_bw, _testing)
-        network_modifiers = [adv_insertion]
+        modifiers = [adv_insertion]
         # create other network modification object
         if (args.other_network_modifier is not None):
             # dynamically import module and obtain reference to class
@@ -1830,20 +3127,25 @@ pathsim, and pickle it. The pickled object is input to the simulate command')
             network_modifier_class = getattr(network_modifier_module, classname)
             # create object of class
             other_network_modifier = network_modifier_class(args, _testing)
-            network_modifiers.append(other_network_modifier)
+            modifiers.append(other_network_modifier)
         # create iterator that applies network modifiers to nsf list
         network_states = get_network_states(network_state_files,
-                                            network_modifiers)
+                                            modifiers)
+        if (args.prefetch > 0):
+            network_states = prefetch_network_states(network_states,
+                                                     args.prefetch)
 
         # determine start and end times
-        start_time = None
-        with open(network_state_files[0]) as nsf:
-            consensus = pickle.load(nsf)
-            start_time = timestamp(consensus.valid_after)
-        end_time = None
-        with open(network_state_files[-1]) as nsf:
-            consensus = pickle.load(nsf)
-            end_time = timestamp(consensus.fresh_until)
+        if (network_state_files[0] in nsf_times):
+            start_time, _ = nsf_times[network_state_files[0]]
+        else:
+            start_time, _ = nsf_format.read_network_state_times(
+                network_state_files[0])
+        if (network_state_files[-1] in nsf_times):
+            _, end_time = nsf_times[network_state_files[-1]]
+        else:
+            _, end_time = nsf_format.read_network_state_times(
+                network_state_files[-1])
 
         # get our stream creation model from our user traces
         # available sessions:
@@ -1880,13 +3182,39 @@ pathsim, and pickle it. The pickled object is input to the simulate command')
         output_module = importlib.import_module(output_modulename)
         output_class = getattr(output_module, output_classname)
         callbacks = output_class(args.format, _testing, file=sys.stdout)
-        callbacks.start()
+        if args.resume:
+            if (args.checkpoint is None):
+                print('No --checkpoint file given to resume from')
+                exit(-1)
+            # output continues from the checkpoint, without the header
+            sys.stderr.write('Resuming from checkpoint, so output of an \
+earlier run from the checkpoint time on should be discarded\n')
+        else:
+            callbacks.start()
 
         # simulate circuit creation and stream assignment
-        create_circuits(network_states, streams, args.num_samples, congmodel,
-                        pdelmodel, callbacks)
+        if (args.workers > 1) or (args.segments > 1):
+            create_circuits_in_workers(network_states, streams,
+                                       args.num_samples, congmodel, pdelmodel, args.workers,
+                                       lambda file: output_class(args.format, _testing, file=file),
+                                       args.first_sample, args.random_seed, args.checkpoint,
+                                       args.checkpoint_interval, args.resume, args.segments,
+                                       args.warmup_periods)
+        else:
+            create_circuits(network_states, streams, args.num_samples,
+                            congmodel, pdelmodel, callbacks, args.first_sample,
+                            args.random_seed, args.checkpoint, args.checkpoint_interval,
+                            args.resume)
     elif (args.subparser == 'concattraces'):
         ut = UserTraces(args.facebook_filename, args.gmailchat_filename,
                         args.gcalgdocs_filename, args.websearch_filename,
                         args.irc_filename, args.bittorrent_filename)
         ut.save_pickle(args.out_name)
+
+
+if __name__ == '__main__':
+    # run as the pathsim module imported by the other modules, so that there
+    # is one copy of its state and pickled objects (e.g. checkpoints) refer
+    # to its classes
+    import pathsim
+    pathsim.main()
@@ -10,6 +10,7 @@ from os import listdir
 from os.path import isfile, join
 from descriptor_reader import DescriptorReader
 import psutil
+import nsf_format
 from datetime import datetime, timedelta
 
 
@@ -39,7 +40,8 @@ def read_descriptors((chunk, files)):
     return descriptors
 
 
-def process_consensuses(in_dirs, fat, initial_descriptor_dir):
+def process_consensuses(in_dirs, fat, initial_descriptor_dir, output_format='columnar', keyframe_interval=0,
+                        archive=False):
     """For every input consensus, finds the descriptors published most recently before the descriptor times listed for
     the relays in that consensus, records state changes indicated by descriptors published during the consensus fresh
     period, and writes out pickled consensus and descriptor objects with the relevant information.
@@ -48,6 +50,10 @@ def process_consensuses(in_dirs, fat, initial_descriptor_dir):
                 processed descriptor out dir) triples *in order*
             fat: Whether to use "fat" (aka full) representation or custom slim classes
             initial_descriptor_dir: Contains descriptors to initialize processing.
+            output_format: 'columnar' or 'pickle' network state files (fat output is always pickled)
+            keyframe_interval: If greater than 1, write columnar network state files as chains of this many files,
+                each a complete keyframe followed by deltas against the previous file
+            archive: Whether to write each month of columnar network state files into a single archive file
     """
     descriptors = {}
     if fat:
@@ -97,14 +103,18 @@ def process_consensuses(in_dirs, fat, initial_descriptor_dir):
 
     if nb_processes == 1:
         for in_consensuses_dir, _, desc_out_dir in in_dirs:
-            process_batch_of_consensuses((desc_out_dir, descriptors, fat, in_consensuses_dir))
+            process_batch_of_consensuses((desc_out_dir, descriptors, fat, in_consensuses_dir, output_format,
+                                          keyframe_interval, archive))
     else:
         p = multiprocessing.Pool(nb_processes)
         p.map(process_batch_of_consensuses,
               [(desc_out_dir,
                 filter_descriptors_for_process(descriptors, in_consensuses_dir),
                 fat,
-                in_consensuses_dir)
+                in_consensuses_dir,
+                output_format,
+                keyframe_interval,
+                archive)
                for in_consensuses_dir, _, desc_out_dir in in_dirs])
 
 
@@ -127,20 +137,56 @@ def filter_descriptors_for_process(descriptors, in_consensus_dir):
     return filtered
 
 
-def process_batch_of_consensuses((desc_out_dir, descriptors, fat, in_consensuses_dir)):
+def process_batch_of_consensuses((desc_out_dir, descriptors, fat, in_consensuses_dir, output_format,
+                                  keyframe_interval, archive)):
     # output pickled consensuses, dict of most recent descriptors, and
     # list of hibernation status changes
+    # each batch starts with a keyframe so that months can be read independently
     pathnames = []
     for dirpath, dirnames, fnames in os.walk(in_consensuses_dir):
         for fname in fnames:
             pathnames.append(os.path.join(dirpath, fname))
     pathnames.sort()
     pathnames = [path for path in pathnames if os.path.basename(path)[0] != '.']
+    if archive:
+        archive_path = os.path.join(desc_out_dir,
+                                    os.path.basename(os.path.normpath(desc_out_dir)) + nsf_format.ARCHIVE_EXTENSION)
+        archive = nsf_format.NetworkStateArchiveWriter(archive_path)
+    else:
+        archive = None
+    base = None
+    files_since_keyframe = 0
+    manifest_states = []
     for pathname in pathnames:
-        process_one_consensus(desc_out_dir, descriptors, fat, pathname)
+        if (keyframe_interval <= 1) or (files_since_keyframe >= keyframe_interval):
+            base = None
+        network_state = process_one_consensus(desc_out_dir, descriptors, fat, pathname, output_format, base,
+                                              archive)
+        if network_state is not None:
+            if base is None:
+                files_since_keyframe = 0
+            files_since_keyframe += 1
+            base = network_state
+            if not fat:
+                consensus_out, descriptors_out = network_state
+                name = consensus_out.valid_after.strftime(nsf_format.NSF_NAME_FORMAT)
+                manifest_states.append((name, pathsim.timestamp(consensus_out.valid_after),
+                                        pathsim.timestamp(consensus_out.fresh_until), len(consensus_out.relays),
+                                        len(descriptors_out),
+                                        name if archive is None else os.path.basename(archive.path)))
+    if archive is not None:
+        archive.close()
+        print('Wrote archive {0}'.format(archive.path))
+    # record times, counts, and checksums so simulations needn't read files to find them
+    if not fat:
+        nsf_format.write_manifest(desc_out_dir, manifest_states)
 
 
-def process_one_consensus(desc_out_dir, descriptors, fat, pathname):
+def process_one_consensus(desc_out_dir, descriptors, fat, pathname, output_format='columnar', base=None,
+                          archive=None):
+    """Writes network state file for consensus at pathname, as a delta against base (the (consensus, descriptors)
+    returned for the previous file) if given, and into archive (a NetworkStateArchiveWriter) if given. Returns
+    (consensus, descriptors) written, or None if none written."""
     filename = os.path.basename(pathname)
     print('Processing consensus file {0}'.format(filename))
     cons_f = open(pathname, 'rb')
@@ -265,15 +311,23 @@ def process_one_consensus(desc_out_dir, descriptors, fat, pathname):
             else:
                 consensus_out = str(consensus)
         hibernating_statuses.sort(key=lambda x: x[0], reverse=True)
-        outpath = os.path.join(desc_out_dir, cons_valid_after.strftime('%Y-%m-%d-%H-%M-%S-network_state'))
-        f = open(outpath, 'wb')
-        pickle.dump(consensus_out, f, pickle.HIGHEST_PROTOCOL)
-        pickle.dump(descriptors_out, f, pickle.HIGHEST_PROTOCOL)
-        pickle.dump(hibernating_statuses, f, pickle.HIGHEST_PROTOCOL)
-        f.close()
+        outpath = os.path.join(desc_out_dir, cons_valid_after.strftime(nsf_format.NSF_NAME_FORMAT))
+        if archive is not None:
+            archive.add(consensus_out, descriptors_out, hibernating_statuses, base)
+        elif (not fat) and (output_format == 'columnar'):
+            nsf_format.write_network_state_file(outpath, consensus_out, descriptors_out, hibernating_statuses, base)
+        else:
+            f = open(outpath, 'wb')
+            pickle.dump(consensus_out, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(descriptors_out, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(hibernating_statuses, f, pickle.HIGHEST_PROTOCOL)
+            f.close()
 
         print('Wrote descriptors for {0} relays.'.format(num_found))
         print('Did not find descriptors for {0} relays\n'.format(num_not_found))
+        network_state = (consensus_out, descriptors_out)
     else:
         print('Problem parsing {0}.'.format(filename))
+        network_state = None
     cons_f.close()
+    return network_state
@@ -0,0 +1,160 @@
+import collections
+import math
+import sys
+
+usage = 'Usage: compare_pathsim_output.py [reference output] [other output] \
+[start_time] [end_time]'
+
+
+def read_output(filename, start_time, end_time):
+    """Returns (format, lines) of pathsim output in filename, with lines the
+    split stream lines with start_time <= timestamp < end_time. Format is
+    'relay-adv', 'network-adv' or 'normal' by the number of header fields."""
+    num_header_fields = None
+    lines = []
+    with open(filename) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            # advance past header
+            if (fields[0] == 'Sample'):
+                num_header_fields = len(fields)
+                continue
+            if (len(fields) < 2):
+                continue
+            timestamp = float(fields[1])
+            if (timestamp >= start_time) and (timestamp < end_time):
+                lines.append(fields)
+    if (num_header_fields == 3):
+        format = 'relay-adv'
+    elif (num_header_fields == 5):
+        format = 'network-adv'
+    else:
+        format = 'normal'
+    return (format, lines)
+
+
+def get_sample_stats(format, lines):
+    """Returns dict of statistic name to list of its values per sample."""
+    samples = collections.defaultdict(list)
+    for fields in lines:
+        samples[fields[0]].append(fields)
+    stats = collections.defaultdict(list)
+    for sample_id in sorted(samples):
+        sample_lines = samples[sample_id]
+        stats['streams'].append(len(sample_lines))
+        stats['unassigned streams'].append(len([fields for fields in \
+            sample_lines if (len(fields) == 2)]))
+        assigned = [fields for fields in sample_lines if (len(fields) > 2)]
+        if (format == 'relay-adv'):
+            codes = [int(fields[2]) for fields in assigned]
+            stats['guard compromised'].append(int(any((code & 1) for code in \
+                codes)))
+            stats['exit compromised'].append(int(any((code & 2) for code in \
+                codes)))
+            stats['fraction of streams compromised'].append(
+                float(codes.count(3)) / max(1, len(codes)))
+        else:
+            if (format == 'network-adv'):
+                exit_field = 3
+            else:
+                exit_field = 4
+            stats['distinct guards'].append(len(set(fields[2] for fields in \
+                assigned)))
+            stats['distinct exits'].append(len(set(fields[exit_field] for \
+                fields in assigned)))
+    return stats
+
+
+def get_stream_distributions(format, lines):
+    """Returns dict of position name to distribution (dict of relay IP to
+    fraction of assigned streams) of the relays used there."""
+    if (format == 'relay-adv'):
+        positions = {'compromise code': 2}
+    elif (format == 'network-adv'):
+        positions = {'guard': 2, 'exit': 3}
+    else:
+        positions = {'guard': 2, 'middle': 3, 'exit': 4}
+    distributions = {}
+    for position, field in positions.iteritems():
+        counts = collections.defaultdict(int)
+        num_streams = 0
+        for fields in lines:
+            if (len(fields) > field):
+                counts[fields[field]] += 1
+                num_streams += 1
+        distributions[position] = dict((ip, float(count) / num_streams) for \
+            ip, count in counts.iteritems())
+    return distributions
+
+
+def mean_var(values):
+    """Returns (mean, sample variance) of list of values."""
+    mean = float(sum(values)) / len(values)
+    if (len(values) < 2):
+        return (mean, 0.0)
+    var = sum((value - mean) ** 2 for value in values) / (len(values) - 1)
+    return (mean, var)
+
+
+def welch_t(values1, values2):
+    """Returns Welch's t statistic of difference of means of values1 and
+    values2, or None if undefined."""
+    mean1, var1 = mean_var(values1)
+    mean2, var2 = mean_var(values2)
+    se = math.sqrt(var1 / len(values1) + var2 / len(values2))
+    if (se == 0):
+        return None
+    return (mean2 - mean1) / se
+
+
+def total_variation_distance(distribution1, distribution2):
+    """Returns total variation distance of two discrete distributions."""
+    keys = set(distribution1) | set(distribution2)
+    return 0.5 * sum(abs(distribution1.get(key, 0) - \
+        distribution2.get(key, 0)) for key in keys)
+
+
+if __name__ == '__main__':
+    """Reports the statistical difference of pathsim output (e.g. of a run
+    with --segments) from reference output (e.g. of an unsegmented run) over
+    the range of stream timestamps [start_time, end_time). Per-sample
+    statistics are compared by mean, with Welch's t statistic of the
+    difference (|t| above about 2 suggests a real difference for more than
+    a few dozen samples), and the relays used by streams at each position by
+    total variation distance."""
+    if (len(sys.argv) < 3):
+        print(usage)
+        sys.exit(1)
+    ref_filename = sys.argv[1]
+    other_filename = sys.argv[2]
+    start_time = float(sys.argv[3]) if (len(sys.argv) > 3) else 0
+    end_time = float(sys.argv[4]) if (len(sys.argv) > 4) else float('inf')
+
+    ref_format, ref_lines = read_output(ref_filename, start_time, end_time)
+    other_format, other_lines = read_output(other_filename, start_time,
+                                            end_time)
+    if (ref_format != other_format):
+        print('Outputs have different formats: {0} and {1}'.format(ref_format,
+            other_format))
+        sys.exit(1)
+    if (len(ref_lines) == 0) or (len(other_lines) == 0):
+        print('No streams in time range')
+        sys.exit(1)
+
+    ref_stats = get_sample_stats(ref_format, ref_lines)
+    other_stats = get_sample_stats(other_format, other_lines)
+    print('Samples: {0} reference, {1} other'.format(
+        len(ref_stats['streams']), len(other_stats['streams'])))
+    print('Statistic per sample\tReference mean\tOther mean\tWelch t')
+    for name in sorted(ref_stats):
+        t = welch_t(ref_stats[name], other_stats[name])
+        print('{0}\t{1:.4f}\t{2:.4f}\t{3}'.format(name,
+            mean_var(ref_stats[name])[0], mean_var(other_stats[name])[0],
+            'n/a' if (t is None) else '{0:.2f}'.format(t)))
+
+    ref_distributions = get_stream_distributions(ref_format, ref_lines)
+    other_distributions = get_stream_distributions(other_format, other_lines)
+    print('Stream distribution\tTotal variation distance')
+    for position in sorted(ref_distributions):
+        print('{0}\t{1:.4f}'.format(position, total_variation_distance(
+            ref_distributions[position], other_distributions[position])))
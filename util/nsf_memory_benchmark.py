@@ -0,0 +1,106 @@
+import gc
+import multiprocessing
+import os
+import sys
+
+import psutil
+
+import pathsim
+
+usage = 'Usage: nsf_memory_benchmark.py [network state file] [num_hours]'
+
+
+class DictRouterStatusEntry:
+    """RouterStatusEntry as it was before slots, with a per-instance dict."""
+
+    def __init__(self, fingerprint, nickname, flags, bandwidth, flag_bits):
+        self.fingerprint = fingerprint
+        self.nickname = nickname
+        self.flags = flags
+        self.bandwidth = bandwidth
+        self.flag_bits = flag_bits
+
+
+class DictServerDescriptor:
+    """ServerDescriptor as it was before slots, with a per-instance dict."""
+
+    def __init__(self, fingerprint, hibernating, nickname, family, address,
+                 exit_policy, ntor_onion_key):
+        self.fingerprint = fingerprint
+        self.hibernating = hibernating
+        self.nickname = nickname
+        self.family = family
+        self.address = address
+        self.exit_policy = exit_policy
+        self.ntor_onion_key = ntor_onion_key
+
+
+def copy_str(s):
+    """Returns an uninterned copy of s, as each hour's unpickling produced."""
+    if (s is None):
+        return None
+    return (s + '.')[:-1]
+
+
+def to_dict_objects(network_state):
+    """Returns (cons_rel_stats, descriptors) of network_state rebuilt with the
+    unslotted classes and uninterned strings."""
+    cons_rel_stats = {}
+    for fprint, rel_stat in network_state.cons_rel_stats.iteritems():
+        fprint = copy_str(fprint)
+        cons_rel_stats[fprint] = DictRouterStatusEntry(fprint,
+            copy_str(rel_stat.nickname), list(rel_stat.flags),
+            rel_stat.bandwidth, rel_stat.flag_bits)
+    descriptors = {}
+    for fprint, desc in network_state.descriptors.iteritems():
+        fprint = copy_str(fprint)
+        descriptors[fprint] = DictServerDescriptor(fprint, desc.hibernating,
+            copy_str(desc.nickname), set(copy_str(m) for m in desc.family),
+            desc.address, desc.exit_policy, desc.ntor_onion_key)
+    return (cons_rel_stats, descriptors)
+
+
+def measure((ns_file, num_hours, slotted)):
+    """Returns resident bytes per hour of network state held in memory."""
+    gc.collect()
+    process = psutil.Process(os.getpid())
+    rss_start = process.memory_info().rss
+    hours = []
+    for i in xrange(num_hours):
+        network_state = pathsim.get_network_state(ns_file)
+        if slotted:
+            hours.append(network_state)
+        else:
+            hours.append(to_dict_objects(network_state))
+        del network_state
+    gc.collect()
+    return float(process.memory_info().rss - rss_start) / num_hours
+
+
+if __name__ == '__main__':
+    """Measures resident memory per hour of network state held by the
+    simulator, with the slotted classes and interned strings of pathsim and
+    with equivalent unslotted classes and uninterned strings. Each measurement
+    loads the given (non-delta) network state file num_hours times in a fresh
+    process. Run from the TorPS directory."""
+    if (len(sys.argv) < 2):
+        print(usage)
+        sys.exit(1)
+    ns_file = sys.argv[1]
+    num_hours = int(sys.argv[2]) if (len(sys.argv) > 2) else 24
+
+    results = {}
+    for slotted in (False, True):
+        pool = multiprocessing.Pool(1)
+        results[slotted] = pool.apply(measure, ((ns_file, num_hours, slotted),))
+        pool.close()
+        pool.join()
+    network_state = pathsim.get_network_state(ns_file)
+    print('{0} relays, {1} descriptors'.format(
+        len(network_state.cons_rel_stats), len(network_state.descriptors)))
+    print('Resident bytes per hour before (unslotted): {0:.0f}'.format(
+        results[False]))
+    print('Resident bytes per hour after (slotted): {0:.0f}'.format(
+        results[True]))
+    print('Reduction: {0:.1f}%'.format(
+        100.0 * (1 - results[True] / results[False])))